@@ -96,11 +96,14 @@ TEMPLATE_LOADERS = (
 )
 
 MIDDLEWARE_CLASSES = (
+    'surveymaker.middleware.ProfileMiddleware',
     'django.middleware.common.CommonMiddleware',
     'django.contrib.sessions.middleware.SessionMiddleware',
     'django.middleware.csrf.CsrfViewMiddleware',
     'django.contrib.auth.middleware.AuthenticationMiddleware',
     'django.contrib.messages.middleware.MessageMiddleware',
+    'surveymaker.middleware.AdminBatchMiddleware',
+    'surveymaker.middleware.SchemaBatchMiddleware',
 )
 
 ROOT_URLCONF = 'dynamic_models.urls'
@@ -124,6 +127,7 @@ INSTALLED_APPS = (
     'django.contrib.messages',
     'django.contrib.staticfiles',
     'django.contrib.admin',
+    'south',
     'surveymaker',
 )
 
@@ -2,8 +2,12 @@
 # -*- coding: UTF-8 -*-
 
 from django.contrib import admin 
-from django.db.models.signals import post_save
+from django.core.urlresolvers import RegexURLResolver, Resolver404, reverse
+from django.db.models.signals import post_save, class_prepared
+from django.http import Http404
+from django.shortcuts import get_object_or_404
 
+from . import app_settings
 from . import models
 from . import utils
 
@@ -13,14 +17,58 @@ class QuestionInline(admin.TabularInline):
 class SurveyAdmin(admin.ModelAdmin):
     inlines = [QuestionInline]
 
+    # Response models aren't listed on the admin index when served through
+    # response_admin_view, so link to them from here
+    if app_settings.DYNAMIC_ADMIN:
+        list_display = ['name', 'responses_link']
+
+    def responses_link(self, obj):
+        url = reverse('surveymaker_response_admin', kwargs={'survey_slug': obj.slug, 'url': ''})
+        return '<a href="%s">Responses</a>' % url
+    responses_link.allow_tags = True
+    responses_link.short_description = 'Responses'
+
 admin.site.register(models.Survey, SurveyAdmin)
 
-# Go through all the current loggers in the database, and register an admin
-for survey in models.Survey.objects.all():
-    utils.reregister_in_admin(admin.site, survey.Response)
 
-# Update definitions when they change
-def survey_post_save(sender, instance, created, **kwargs):
-    utils.reregister_in_admin(admin.site, instance.Response)
-post_save.connect(survey_post_save, sender=models.Survey)
+def response_admin_view(request, survey_slug, url):
+    """ Serves the admin for a survey's responses, using the current response
+        model. Used instead of registering each response model in the admin
+        when SURVEYMAKER_DYNAMIC_ADMIN is set.
+    """
+    survey = get_object_or_404(models.Survey, slug=survey_slug)
+    model_admin = get_response_model_admin(survey.Response)
+    try:
+        match = RegexURLResolver(r'^', model_admin.get_urls()).resolve(url)
+    except Resolver404:
+        raise Http404
+    return match.func(request, *match.args, **match.kwargs)
+
+
+def get_response_model_admin(model):
+    """ Returns a ModelAdmin for the given response model. It is kept on the
+        model, so that it is replaced whenever the model is.
+    """
+    if '_model_admin' not in model.__dict__:
+        model._model_admin = admin.ModelAdmin(model, admin.site)
+    return model._model_admin
+
+
+if not app_settings.DYNAMIC_ADMIN:
+
+    # Go through all the current loggers in the database, and register an admin
+    with utils.admin_batch():
+        for survey in models.Survey.objects.all():
+            utils.reregister_in_admin(admin.site, survey.Response)
+
+    # Register models that are built later, eg. for surveys added by another process
+    def response_model_prepared(sender, **kwargs):
+        if sender._meta.app_label == 'responses' and not any(
+                m._meta.db_table == sender._meta.db_table for m in admin.site._registry):
+            utils.reregister_in_admin(admin.site, sender)
+    class_prepared.connect(response_model_prepared)
 
+    # Update definitions when they change
+    def survey_post_save(sender, instance, created, **kwargs):
+        utils.reregister_in_admin(admin.site, instance.Response)
+    post_save.connect(survey_post_save, sender=models.Survey)
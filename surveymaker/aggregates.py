@@ -0,0 +1,129 @@
+# -*- coding: UTF-8 -*-
+""" Summaries of a survey's responses, calculated by the database.
+    All of a survey's questions are summarised with a single query, which
+    makes one pass over the response table.
+"""
+
+from decimal import Decimal
+import uuid
+
+from django.core.cache import cache
+from django.db import connection
+from django.db.models.fields import FieldDoesNotExist
+from django.utils.datastructures import SortedDict
+
+from . import app_settings
+from .dynamic_models import get_field_name
+
+# Answer types that are summarised with their count, sum, minimum and maximum
+NUMERIC_TYPES = ('Integer', 'Decimal')
+
+AGGREGATE_CACHE_TEMPLATE = 'survey_aggregates_%s-%s-%s'
+AGGREGATE_GENERATION_TEMPLATE = 'survey_aggregates_generation_%s'
+
+
+def get_response_aggregates(survey):
+    """ Returns a dict with the number of responses to the survey, and a
+        summary of the answers to each question (by slug, in order):
+        for questions with choices, the number of times each was chosen,
+        for numeric questions, the count, sum, min, max and mean of answers.
+        Results are cached until the model changes, or responses are added,
+        changed or deleted (see invalidate_aggregates).
+    """
+    Response = survey.Response
+    cache_key = AGGREGATE_CACHE_TEMPLATE % (survey.pk, Response._hash,
+                                            _get_generation(survey.pk))
+    aggregates = cache.get(cache_key)
+    if aggregates is None:
+        aggregates = calculate_aggregates(Response, survey.question_set.all())
+        cache.set(cache_key, aggregates, app_settings.AGGREGATE_CACHE_TIMEOUT)
+    return aggregates
+
+
+def invalidate_aggregates(survey_id):
+    """ Stops the survey's cached aggregates being used, after its responses
+        have been added, changed or deleted.
+    """
+    cache.delete(AGGREGATE_GENERATION_TEMPLATE % survey_id)
+
+
+def _get_generation(survey_id):
+    """ Returns the token that the survey's current aggregates are cached
+        under, which is replaced each time they are invalidated.
+    """
+    key = AGGREGATE_GENERATION_TEMPLATE % survey_id
+    generation = cache.get(key)
+    if generation is None:
+        generation = uuid.uuid4().hex
+        if not cache.add(key, generation):
+            generation = cache.get(key) or generation
+    return generation
+
+
+def calculate_aggregates(Response, questions):
+    """ Summarises the answers to the given questions with one query. """
+    qn = connection.ops.quote_name
+    columns = ['COUNT(*)']
+    params = []
+    readers = []
+
+    for question in questions:
+        try:
+            field = Response._meta.get_field(get_field_name(question))
+        except FieldDoesNotExist:
+            continue
+        column = qn(field.column)
+
+        if field.choices:
+            choices = list(field.choices)
+            for value, label in choices:
+                columns.append('SUM(CASE WHEN %s = %%s THEN 1 ELSE 0 END)' % column)
+                params.append(field.get_db_prep_save(value, connection=connection))
+            readers.append((question.slug, _read_choices(choices)))
+
+        elif question.answer_type in NUMERIC_TYPES:
+            for function in ('COUNT', 'SUM', 'MIN', 'MAX'):
+                columns.append('%s(%s)' % (function, column))
+            readers.append((question.slug, _read_numbers(field)))
+
+    sql = 'SELECT %s FROM %s' % (', '.join(columns), qn(Response._meta.db_table))
+    cursor = connection.cursor()
+    cursor.execute(sql, params)
+    row = list(cursor.fetchone())
+
+    aggregates = {'responses': row.pop(0), 'questions': SortedDict()}
+    for slug, reader in readers:
+        aggregates['questions'][slug] = reader(row)
+    return aggregates
+
+
+def _read_choices(choices):
+    def reader(row):
+        return {'choices': [(value, label, int(row.pop(0) or 0)) for value, label in choices]}
+    return reader
+
+
+def _read_numbers(field):
+    def reader(row):
+        count, total, minimum, maximum = [row.pop(0) for i in range(4)]
+        count = int(count or 0)
+        total, minimum, maximum = [to_number(field, v) for v in (total, minimum, maximum)]
+        return {
+            'count': count,
+            'sum': total or 0,
+            'min': minimum,
+            'max': maximum,
+            'mean': Decimal(total) / count if count else None,
+            }
+    return reader
+
+
+def to_number(field, value):
+    """ Converts a number returned by the database (some return floats for
+        decimal columns) to the field's type.
+    """
+    if value is None:
+        return None
+    if field.get_internal_type() == 'DecimalField':
+        return Decimal(str(value))
+    return int(value)
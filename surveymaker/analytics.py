@@ -0,0 +1,94 @@
+# -*- coding: UTF-8 -*-
+""" Loading of a survey's responses into NumPy arrays, a column per question,
+    for offline analysis. Responses are read a chunk at a time with
+    values_list, and each chunk is converted a column at a time, so no model
+    instances (or per row tuples of converted values) are created.
+
+    NumPy is only needed when these functions are used.
+"""
+
+from django.utils.datastructures import SortedDict
+
+from .export import iter_response_chunks
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+
+# The NumPy type of each kind of field made by fields.ANSWER_FIELDS.
+# Integer and decimal answers are given as masked arrays, masking unanswered
+# questions. Anything else (ie. text) is kept as python objects.
+FIELD_DTYPES = {
+    'IntegerField': 'int64',
+    'DecimalField': 'float64',
+    }
+
+# Choice answers are given as the index of the choice in the field's choices,
+# or this for no (or an unknown) choice.
+NO_CHOICE = -1
+
+
+def load_response_arrays(Response, chunk_size=None):
+    """ Returns a SortedDict of the response ids ('id'), then the answers to
+        each question (by field name, in order), as NumPy arrays.
+        Answers to questions with choices are given as codes, see
+        get_categories().
+    """
+    if numpy is None:
+        raise ImportError("NumPy is needed to load responses into arrays.")
+
+    fields = [Response._meta.get_field(name) for name in Response._data_fields]
+    converters = [('id', _convert_ids)]
+    converters += [(field.name, get_converter(field)) for field in fields]
+
+    chunks = dict((name, []) for name, convert in converters)
+    for chunk in iter_response_chunks(Response, chunk_size=chunk_size):
+        for (name, convert), values in zip(converters, zip(*chunk)):
+            chunks[name].append(convert(values))
+
+    arrays = SortedDict()
+    for name, convert in converters:
+        arrays[name] = _join(chunks[name]) if chunks[name] else convert(())
+    return arrays
+
+
+def get_categories(Response):
+    """ Returns the choices (values) of each question with choices, by field
+        name, in the order that the codes of load_response_arrays() refer to.
+    """
+    categories = {}
+    for name in Response._data_fields:
+        field = Response._meta.get_field(name)
+        if field.choices:
+            categories[name] = tuple(value for value, label in field.choices)
+    return categories
+
+
+def get_converter(field):
+    """ Returns a function that makes an array of the given field's values. """
+    if field.choices:
+        codes = dict((value, i) for i, (value, label) in enumerate(field.choices))
+        return lambda values: numpy.fromiter((codes.get(v, NO_CHOICE) for v in values),
+                                             'int32', len(values))
+
+    dtype = FIELD_DTYPES.get(field.get_internal_type())
+    if dtype is None:
+        return lambda values: numpy.array(values, dtype=object)
+
+    def convert(values):
+        data = numpy.fromiter((0 if v is None else v for v in values), dtype, len(values))
+        mask = numpy.fromiter((v is None for v in values), bool, len(values))
+        return numpy.ma.MaskedArray(data, mask=mask)
+    return convert
+
+
+def _convert_ids(values):
+    return numpy.fromiter(values, 'int64', len(values))
+
+
+def _join(arrays):
+    if isinstance(arrays[0], numpy.ma.MaskedArray):
+        return numpy.ma.concatenate(arrays)
+    return numpy.concatenate(arrays)
@@ -0,0 +1,96 @@
+# -*- coding: UTF-8 -*-
+""" Settings for the surveymaker app and their default values.
+    Each can be overridden in the project settings, using the SURVEYMAKER_
+    prefix, eg. SURVEYMAKER_MODEL_CACHE_SIZE = 100
+"""
+
+from django.conf import settings
+from django.core.exceptions import ImproperlyConfigured
+
+
+# Whether response models are only built when first needed, rather than all
+# at once on startup. Each model's table is then checked the first time the
+# process builds it.
+LAZY_MODELS = getattr(settings, 'SURVEYMAKER_LAZY_MODELS', False)
+
+# When several processes build the same model at once, only one checks its
+# table, holding a lease in the shared cache for up to SCHEMA_LEASE_TIMEOUT
+# seconds. The others wait up to SCHEMA_LEASE_WAIT seconds for it to finish,
+# then use the model without checking the table themselves.
+SCHEMA_LEASE_TIMEOUT = getattr(settings, 'SURVEYMAKER_SCHEMA_LEASE_TIMEOUT', 30)
+SCHEMA_LEASE_WAIT = getattr(settings, 'SURVEYMAKER_SCHEMA_LEASE_WAIT', 2)
+
+# The maximum number of response models each process keeps. The least
+# recently used are removed (including from the admin) and rebuilt when next
+# needed. None means there is no limit.
+MODEL_CACHE_SIZE = getattr(settings, 'SURVEYMAKER_MODEL_CACHE_SIZE', None)
+
+# Whether the response models are served in the admin through a single
+# route (admin/responses/<survey slug>/...) that looks the model up on each
+# request, instead of registering each model with the admin site. Changes to
+# surveys then never need the URL conf to be reloaded.
+# This is needed when models are built lazily or can be evicted, as a model
+# can only be registered with the admin site once it has been built.
+DYNAMIC_ADMIN = getattr(settings, 'SURVEYMAKER_DYNAMIC_ADMIN',
+                        LAZY_MODELS or MODEL_CACHE_SIZE is not None)
+if not DYNAMIC_ADMIN and (LAZY_MODELS or MODEL_CACHE_SIZE is not None):
+    raise ImproperlyConfigured("SURVEYMAKER_DYNAMIC_ADMIN is needed with "
+                               "SURVEYMAKER_LAZY_MODELS or SURVEYMAKER_MODEL_CACHE_SIZE.")
+
+# The dotted path of a transport class from surveymaker.invalidation (eg.
+# 'surveymaker.invalidation.RedisTransport') used to tell every process
+# straight away when a dynamic model changes, and the keyword arguments to
+# create it with. Without one (or if a message is lost), a process notices
+# a changed model when it next sees the survey's new schema version.
+INVALIDATION_TRANSPORT = getattr(settings, 'SURVEYMAKER_INVALIDATION_TRANSPORT', None)
+INVALIDATION_OPTIONS = getattr(settings, 'SURVEYMAKER_INVALIDATION_OPTIONS', {})
+
+# How many responses are inserted with each statement when loading in bulk.
+BULK_CHUNK_SIZE = getattr(settings, 'SURVEYMAKER_BULK_CHUNK_SIZE', 500)
+
+# How many responses are fetched with each query when exporting.
+EXPORT_CHUNK_SIZE = getattr(settings, 'SURVEYMAKER_EXPORT_CHUNK_SIZE', 1000)
+
+# How many surveys are shown on each page of the index, and how many of each
+# survey's latest responses are shown.
+INDEX_PAGE_SIZE = getattr(settings, 'SURVEYMAKER_INDEX_PAGE_SIZE', 10)
+INDEX_LATEST_RESPONSES = getattr(settings, 'SURVEYMAKER_INDEX_LATEST_RESPONSES', 10)
+
+# The longest (in seconds) that a survey's response aggregates are cached.
+# They are recalculated sooner if responses are added, changed or deleted.
+AGGREGATE_CACHE_TIMEOUT = getattr(settings, 'SURVEYMAKER_AGGREGATE_CACHE_TIMEOUT', 300)
+
+# Whether running totals of each survey's answers are kept in the database
+# (see surveymaker.summaries), so that they can be read without going through
+# every response. Saving a response then costs an update per answer.
+# When turning this on for existing surveys, build their summaries first with
+# summaries.rebuild_survey_summaries().
+RESPONSE_SUMMARIES = getattr(settings, 'SURVEYMAKER_RESPONSE_SUMMARIES', False)
+
+# Whether new and renamed question columns are added to response tables in
+# the background (by the apply_schema_changes command), instead of while the
+# question is saved. Until then, the response model leaves out new questions
+# and reads renamed ones from their old column. Existing rows are updated or
+# copied SCHEMA_CHANGE_BATCH_SIZE at a time.
+ONLINE_SCHEMA_CHANGES = getattr(settings, 'SURVEYMAKER_ONLINE_SCHEMA_CHANGES', False)
+SCHEMA_CHANGE_BATCH_SIZE = getattr(settings, 'SURVEYMAKER_SCHEMA_CHANGE_BATCH_SIZE', 1000)
+
+# The path of a SQLite file to queue responses in, so that submitting a
+# response doesn't wait for the database (see surveymaker.write_queue).
+# When WRITE_QUEUE_MAX_SIZE responses are waiting, responses are saved
+# directly instead. The queue is flushed every WRITE_QUEUE_FLUSH_INTERVAL
+# seconds, or as soon as BULK_CHUNK_SIZE responses are waiting.
+WRITE_QUEUE_PATH = getattr(settings, 'SURVEYMAKER_WRITE_QUEUE_PATH', None)
+WRITE_QUEUE_MAX_SIZE = getattr(settings, 'SURVEYMAKER_WRITE_QUEUE_MAX_SIZE', 10000)
+WRITE_QUEUE_FLUSH_INTERVAL = getattr(settings, 'SURVEYMAKER_WRITE_QUEUE_FLUSH_INTERVAL', 1.0)
+
+# The dotted path of a sink from surveymaker.instrumentation (eg.
+# 'surveymaker.instrumentation.StatsdSink') that receives timings and counts
+# of model generation, schema changes and so on, and the keyword arguments
+# to create it with.
+METRICS_SINK = getattr(settings, 'SURVEYMAKER_METRICS_SINK', None)
+METRICS_OPTIONS = getattr(settings, 'SURVEYMAKER_METRICS_OPTIONS', {})
+
+# Whether surveymaker.middleware.ProfileMiddleware adds headers to each
+# response showing the work done by the dynamic models during the request.
+PROFILE_REQUESTS = getattr(settings, 'SURVEYMAKER_PROFILE_REQUESTS', False)
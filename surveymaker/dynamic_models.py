@@ -1,80 +1,291 @@
 # -*- coding: UTF-8 -*-
 import logging
+from operator import itemgetter
 
-from django.db import models
+from django.db import models, router, transaction
+from django.db.models.query import QuerySet
 from django.utils.hashcompat import md5_constructor
 from django.core.cache import cache
 
+from . import app_settings
+from . import instrumentation
+from . import schema
 from . import utils
 
-def get_survey_response_model(survey, regenerate=False, notify_changes=True):
+# Names of the response models whose tables this process has checked
+_verified_models = set()
+
+
+def get_survey_response_model(survey, regenerate=False, notify_changes=True,
+                              questions=None, pending=None):
     """ Takes a survey object and returns a model for survey responses. 
         Setting regenerate forces a regeneration, regardless of cached models.
-        Setting notify_changes updates the cache with the current hash.
+        Setting notify_changes announces the new model to other processes.
+        The survey's questions and pending columns (see
+        schema_changes.get_pending_columns) can be given, if they have
+        already been fetched.
     """
+    # Once built, a survey's current model is found by its id
+    if not regenerate and survey.pk is not None:
+        model = utils.get_registered_model(survey.pk, survey.schema_version)
+        if model is not None:
+            return model
+
     name = filter(str.isalpha, survey.slug.encode('ascii', 'ignore'))
     _app_label = 'responses'
-    _model_name = 'Response'+name
+    _model_name = get_response_model_name(survey)
 
     # Skip regeneration if we have a valid cached model
-    cached_model = utils.get_cached_model(_app_label, _model_name, regenerate)
+    # The survey's schema version tells us if our model is current, without
+    # needing to consult the shared cache.
+    cached_model = utils.get_cached_model(_app_label, _model_name, survey.schema_version, regenerate)
     if cached_model is not None:
         return cached_model
 
-    # Collect the dynamic model's class attributes
-    attrs = {
-        '__module__': __name__, 
-        '__unicode__': lambda s: '%s response' % name
-    }
+    # Only one thread builds a given model at a time. Threads that were
+    # waiting for it use the model it built, unless they need a new one.
+    with utils.get_model_lock(_app_label, _model_name):
+        if not regenerate:
+            model = models.get_model(_app_label, _model_name)
+            if model is not None and model._schema_version == survey.schema_version:
+                instrumentation.incr_for_model('model_cache.coalesced', model)
+                return model
 
-    class Meta:
-        app_label = 'responses'
-        verbose_name = survey.name + ' Response'
-    attrs['Meta'] = Meta
+        # Collect the dynamic model's class attributes
+        attrs = {
+            '__module__': __name__, 
+            '__unicode__': lambda s: '%s response' % name
+        }
 
-    # Add a field for each question
-    questions = survey.question_set.all()
-    for question in questions:
-        field_name = question.slug.replace('-','_').encode('ascii', 'ignore')
-        attrs[field_name] = question.get_field()
+        class Meta:
+            app_label = 'responses'
+            db_table = get_response_table_name(survey)
+            verbose_name = survey.name + ' Response'
+        attrs['Meta'] = Meta
+
+        # Questions whose columns are still to be added or renamed in the
+        # background are left out, or read from their old column
+        if pending is None:
+            pending = {}
+            if app_settings.ONLINE_SCHEMA_CHANGES:
+                from .schema_changes import get_pending_columns
+                pending = get_pending_columns(survey)
+
+        # Add a field for each question
+        if questions is None:
+            questions = survey.question_set.all()
+        questions = [q for q in questions if pending.get(q.pk) != ""]
+        for question in questions:
+            attrs[get_field_name(question)] = question.get_field()
+            if question.pk in pending:
+                attrs[get_field_name(question)].db_column = pending[question.pk]
+
+        # The names of the question fields, in the order of the questions
+        attrs['_data_fields'] = tuple(get_field_name(question) for question in questions)
+        attrs['_question_ids'] = dict((get_field_name(question), question.pk) for question in questions)
+
+        # Add a hash representing this model to help quickly identify changes
+        attrs['_hash'] = generate_model_hash(survey, questions, pending)
+        attrs['_schema_version'] = survey.schema_version
+        attrs['_survey_id'] = survey.pk
+
+        # A convenience function for getting the data in a predictablly ordered tuple
+        attrs['data'] = property(lambda s: tuple(getattr(s, f) for f in s._data_fields))
+
+        # Responses are saved in the same transaction as the updates made to
+        # their survey's response count (and summaries) by signals.py
+        attrs['save'] = save_response
+
+        # Light weight records for listing responses, see ResponseQuerySet.rows()
+        attrs['objects'] = ResponseManager()
+        attrs['_row_class'] = make_row_class('Response'+name, attrs['_data_fields'])
+
+        # Django keeps a cache of registered models, and would give us back
+        # the previous model instead of our new one
+        utils.remove_from_model_cache(_app_label, _model_name)
+        with instrumentation.timer('model.build', survey=name, regenerate=str(bool(regenerate))):
+            model = type('Response'+name, (models.Model,), attrs)
+        utils.add_to_lru_cache(model)
+
+        # You could create the table and columns here if you're paranoid that it
+        # hasn't happened yet. 
+        #utils.create_db_table(model)
+        # Be wary though, that you won't be able to rename columns unless you
+        # prevent the following line from being run.
+        #utils.add_necessary_db_columns(model)
+        # When models aren't all built on startup, this is done the first time
+        # the model is needed (but never while regenerating for a change).
+        # Only one process checks each version of the table: the others wait
+        # briefly for it to finish, or go ahead without checking.
+        # The survey records the last model its table was checked for, so
+        # no process need check it again.
+        if app_settings.LAZY_MODELS and not regenerate and _model_name not in _verified_models:
+            lease = survey.model_hash != model._hash and utils.acquire_schema_lease(model)
+            if lease:
+                checked = False
+                try:
+                    utils.add_necessary_db_columns(model)
+                    record_table_checked(survey, model)
+                    checked = True
+                finally:
+                    utils.release_schema_lease(model, checked)
+            if lease is not None:
+                _verified_models.add(_model_name)
+
+        if notify_changes:
+            utils.notify_model_change(model)
+
+        return model
+
+
+def save_response(self, *args, **kwargs):
+    """ The save method of response models, which saves the response in a
+        transaction, if the caller isn't already managing one. Otherwise
+        Django commits the new row before sending post_save. (Deleting is
+        already done in a transaction that includes post_delete.)
+    """
+    using = kwargs.get('using') or router.db_for_write(type(self), instance=self)
+    if transaction.is_managed(using=using):
+        return models.Model.save(self, *args, **kwargs)
+    with transaction.commit_on_success(using=using):
+        return models.Model.save(self, *args, **kwargs)
+
+
+class ResponseQuerySet(QuerySet):
+    def rows(self):
+        """ Yields a record of each response's id and answers (a tuple, whose
+            data attribute is the answers in question order) straight
+            from the database, without creating model instances.
+        """
+        Row = self.model._row_class
+        values = self.values_list('pk', *self.model._data_fields)
+        for row in values.iterator():
+            yield Row(row)
 
-    # Add a hash representing this model to help quickly identify changes
-    attrs['_hash'] = generate_model_hash(survey)
 
-    # A convenience function for getting the data in a predictablly ordered tuple
-    attrs['data'] = property(lambda s: tuple(getattr(s, q.slug) for q in questions))
+class ResponseManager(models.Manager):
+    def get_query_set(self):
+        return ResponseQuerySet(self.model, using=self._db)
 
-    model = type('Response'+name, (models.Model,), attrs)
+    def rows(self):
+        return self.get_query_set().rows()
 
-    # You could create the table and columns here if you're paranoid that it
-    # hasn't happened yet. 
-    #utils.create_db_table(model)
-    # Be wary though, that you won't be able to rename columns unless you
-    # prevent the following line from being run.
-    #utils.add_necessary_db_columns(model)
 
-    if notify_changes:
-        utils.notify_model_change(model)
+def make_row_class(model_name, field_names):
+    """ Returns a tuple class for the id and answers of a response, whose
+        values can also be read as attributes named after their fields.
+        Unlike a named tuple, fields can have any name a question slug can
+        have, including Python keywords (read with getattr) and "id".
+    """
+    names = ('id',) + tuple(field_names)
+    attrs = {'__slots__': (), '_fields': names}
+    # The first value with a given name wins, as with a model instance's id
+    for i, name in reversed(list(enumerate(names))):
+        attrs[name] = property(itemgetter(i))
+    attrs['data'] = property(lambda s: s[1:])
+    attrs['__repr__'] = lambda s: '%s(%s)' % (type(s).__name__,
+                            ', '.join('%s=%r' % item for item in zip(s._fields, s)))
+    return type(model_name + 'Row', (tuple,), attrs)
+
+
+def get_survey_response_models(surveys):
+    """ Takes a list of survey objects and returns a list of their response
+        models. Only models that are missing or out of date are regenerated,
+        with the questions (and pending columns) of all of them fetched at
+        once, instead of once per survey.
+    """
+    surveys = list(surveys)
+    found = dict((survey.pk, utils.get_registered_model(survey.pk, survey.schema_version))
+                    for survey in surveys)
+    stale = [survey for survey in surveys if found[survey.pk] is None]
+    if stale:
+        # While models.py is being loaded (see build_existing_survey_response_models)
+        # Question isn't in the model cache yet, so it is found through Survey
+        Question = stale[0].question_set.model
+        questions = dict((survey.pk, []) for survey in stale)
+        for question in Question.objects.filter(survey__in=questions.keys()):
+            questions[question.survey_id].append(question)
+
+        pending = dict((survey.pk, {}) for survey in stale)
+        if app_settings.ONLINE_SCHEMA_CHANGES:
+            from .schema_changes import get_all_pending_columns
+            pending = get_all_pending_columns(stale)
+
+        for survey in stale:
+            found[survey.pk] = get_survey_response_model(
+                survey, questions=questions[survey.pk], pending=pending[survey.pk])
+    return [found[survey.pk] for survey in surveys]
+
+
+def get_field_name(question):
+    """ Returns the name of the response model field for the given question. """
+    return question.slug.replace('-','_').encode('ascii', 'ignore')
+
+
+def get_response_model_name(survey):
+    """ Returns the name of the given survey's response model. """
+    return 'Response' + filter(str.isalpha, survey.slug.encode('ascii', 'ignore'))
 
-    return model
+
+def get_response_table_name(survey):
+    """ Returns the name of the given survey's response table. """
+    return schema.TABLE_PREFIX + get_response_model_name(survey).lower()
 
 
 def build_existing_survey_response_models():
     """ Builds all existing dynamic models at once. """
     # To avoid circular imports, the model is retrieved from the model cache
     Survey = models.get_model('surveymaker', 'Survey')
-    for survey in Survey.objects.all():
-        Response = get_survey_response_model(survey)
-        # Create the table if necessary, shouldn't be necessary anyway
-        utils.create_db_table(Response)
-        # While we're at it...
-        utils.add_necessary_db_columns(Response)
+    surveys = list(Survey.objects.all())
+
+    # Tables that were checked for the current model needn't be checked
+    # again, so if none have changed the database catalog isn't read at all
+    unchecked = [(survey, Response) for survey, Response
+                    in zip(surveys, get_survey_response_models(surveys))
+                    if survey.model_hash != Response._hash]
+    if not unchecked:
+        return
+
+    # Every table is introspected at once, instead of once per survey
+    with schema.sync():
+        for survey, Response in unchecked:
+            # Create the table if necessary, shouldn't be necessary anyway
+            utils.create_db_table(Response)
+            # While we're at it...
+            utils.add_necessary_db_columns(Response)
+            record_table_checked(survey, Response)
+
+
+def record_table_checked(survey, Response):
+    """ Records that the survey's table has the columns of the given model,
+        by storing the model's hash on the survey. Columns are only removed
+        (by renaming) when the questions, and therefore the hash, change.
+    """
+    Survey = models.get_model('surveymaker', 'Survey')
+    Survey.objects.filter(pk=survey.pk).update(model_hash=Response._hash)
+    survey.model_hash = Response._hash
 
 
-def generate_model_hash(survey):
+def generate_model_hash(survey, questions=None, pending=None):
     """ Take a survey object and generate a suitable hash for the relevant
         aspect of responses model. 
-        For our survey model, a list of the question slugs 
+        For our survey model, the relevant fields of each question, which
+        can be passed in if they have already been fetched, and the old
+        columns of questions with pending schema changes.
     """
-    return md5_constructor(survey.get_hash_string()).hexdigest()
+    if questions is None:
+        questions = survey.question_set.all()
+
+    # Each value is length-prefixed, so that the encoding is unambiguous
+    model_hash = md5_constructor()
+    for question in questions:
+        for attr in HASH_FIELDS:
+            value = unicode(getattr(question, attr))
+            model_hash.update((u'%d:%s' % (len(value), value)).encode('utf-8'))
+    for question_id, old_column in sorted((pending or {}).items()):
+        model_hash.update(('pending:%d:%s' % (question_id, old_column)).encode('utf-8'))
+    return model_hash.hexdigest()
+
 
+# The question fields that are relevant to the generated response model
+HASH_FIELDS = ('slug', 'answer_type', 'required', 'question', 'choices', 'rank')
@@ -0,0 +1,84 @@
+# -*- coding: UTF-8 -*-
+""" Streaming export of survey responses, for any number of rows.
+    Responses are read a chunk at a time, ordered by primary key, and never
+    become model instances.
+"""
+
+import csv
+from cStringIO import StringIO
+
+from django.core.serializers.json import DjangoJSONEncoder
+from django.utils import simplejson
+
+from . import app_settings
+
+
+def get_export_columns(Response):
+    """ The exported columns: the primary key, then each question in order. """
+    return ('id',) + tuple(Response._data_fields)
+
+
+def iter_response_values(Response, chunk_size=None):
+    """ Yields a tuple of the values of each response, in the order of
+        get_export_columns().
+    """
+    for chunk in iter_response_chunks(Response, chunk_size=chunk_size):
+        for values in chunk:
+            yield values
+
+
+def iter_response_chunks(Response, fields=None, chunk_size=None):
+    """ Yields lists of up to chunk_size tuples, each holding the primary key
+        of a response and the values of the given fields (by default every
+        question's field). Each chunk is fetched with a query that continues
+        from the last primary key seen, so later chunks cost no more than
+        earlier ones.
+    """
+    chunk_size = chunk_size or app_settings.EXPORT_CHUNK_SIZE
+    if fields is None:
+        fields = Response._data_fields
+    queryset = Response.objects.order_by('pk').values_list('pk', *fields)
+    last_pk = None
+    while True:
+        chunk = queryset if last_pk is None else queryset.filter(pk__gt=last_pk)
+        chunk = list(chunk[:chunk_size])
+        if not chunk:
+            break
+        yield chunk
+        last_pk = chunk[-1][0]
+
+
+def export_csv(Response, chunk_size=None):
+    """ Yields UTF-8 CSV, with a header row, a chunk of rows at a time. """
+    buffer = StringIO()
+    writer = csv.writer(buffer)
+    writer.writerow(get_export_columns(Response))
+
+    for i, values in enumerate(iter_response_values(Response, chunk_size)):
+        writer.writerow([_encode(value) for value in values])
+        if i % 100 == 99:
+            yield buffer.getvalue()
+            buffer.seek(0)
+            buffer.truncate()
+    yield buffer.getvalue()
+
+
+def export_jsonl(Response, chunk_size=None):
+    """ Yields a line of JSON for each response. """
+    columns = get_export_columns(Response)
+    for values in iter_response_values(Response, chunk_size):
+        yield simplejson.dumps(dict(zip(columns, values)), cls=DjangoJSONEncoder) + '\n'
+
+
+EXPORT_FORMATS = {
+    'csv': (export_csv, 'text/csv'),
+    'jsonl': (export_jsonl, 'application/x-ndjson'),
+    }
+
+
+def _encode(value):
+    if value is None:
+        return ''
+    if isinstance(value, unicode):
+        return value.encode('utf-8')
+    return value
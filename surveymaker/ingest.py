@@ -0,0 +1,179 @@
+# -*- coding: UTF-8 -*-
+""" Bulk loading of survey responses, eg. those collected offline. """
+
+import csv
+from functools import partial
+from itertools import islice
+import logging
+
+from django.core.exceptions import ValidationError
+from django.db import connection, transaction, DatabaseError
+from django.utils import simplejson
+
+from . import app_settings
+from .signals import responses_bulk_created
+
+logger = logging.getLogger('surveymaker')
+
+# SQLite refuses statements with more parameters than this
+SQLITE_MAX_VARIABLES = 999
+
+
+def bulk_create_responses(Response, rows, chunk_size=None, on_insert=None):
+    """ Validates and saves many responses at once.
+        rows is an iterable of dicts of field name to (unconverted) value,
+        which is consumed a chunk at a time. Valid rows are inserted with
+        a multi-row INSERT per chunk of chunk_size rows. If given, on_insert
+        is called with the row numbers of each INSERT, before it is committed.
+        Returns the number of responses created and a list of
+        (row number, {field name: [errors]}) for the rows that were skipped,
+        where the first row is row 1.
+    """
+    chunk_size = chunk_size or app_settings.BULK_CHUNK_SIZE
+    fields = get_insert_fields(Response)
+    # Exported responses can be loaded again, with new ids
+    ignored = (Response._meta.pk.name,)
+    if connection.vendor == 'sqlite':
+        chunk_size = max(1, min(chunk_size, SQLITE_MAX_VARIABLES // max(len(fields), 1)))
+
+    created = 0
+    errors = []
+    rows = enumerate(rows, 1)
+    while True:
+        chunk = list(islice(rows, chunk_size))
+        if not chunk:
+            break
+
+        values = []
+        for row_number, row in chunk:
+            if row is None:
+                errors.append((row_number, {'__all__': [u'This row could not be read.']}))
+                continue
+            if not isinstance(row, dict):
+                errors.append((row_number, {'__all__': [u'Each row must be a set of answers.']}))
+                continue
+            try:
+                values.append((row_number, clean_row(fields, row, ignored)))
+            except ValidationError as e:
+                errors.append((row_number, e.message_dict))
+
+        try:
+            insert_rows(Response, fields, [v for n, v in values],
+                        on_insert and partial(on_insert, [n for n, v in values]))
+            created += len(values)
+        except DatabaseError:
+            # Find the offending rows by saving the chunk one row at a time
+            for row_number, row_values in values:
+                try:
+                    insert_rows(Response, fields, [row_values],
+                                on_insert and partial(on_insert, [row_number]))
+                    created += 1
+                except DatabaseError as e:
+                    errors.append((row_number, {'__all__': [unicode(e)]}))
+
+    logger.debug("Bulk created %d %s rows, skipped %d" % (created, Response._meta.object_name, len(errors)))
+    return created, errors
+
+
+def get_insert_fields(Response):
+    """ Returns the fields whose values are given when inserting a response. """
+    return [f for f in Response._meta.local_fields if not f.primary_key]
+
+
+def clean_row(fields, row, ignored=()):
+    """ Returns the python values of the given row, in field order.
+        Raises a ValidationError with a message_dict, listing every problem,
+        including any names in the row that aren't fields (or ignored), so
+        that answers are never silently left out.
+    """
+    names = set(field.name for field in fields)
+    errors = dict((name, [u'There is no question with this slug.'])
+                    for name in row if name not in names and name not in ignored)
+    if not names.intersection(row):
+        errors['__all__'] = [u'This row has no answers.']
+        raise ValidationError(errors)
+
+    values = []
+    for field in fields:
+        raw_value = row.get(field.name)
+        if raw_value in (None, '') and not field.null and field.has_default():
+            raw_value = field.get_default()
+        if raw_value == '' and field.null:
+            raw_value = None
+        try:
+            values.append(field.clean(raw_value, None))
+        except ValidationError as e:
+            errors[field.name] = e.messages
+    if errors:
+        raise ValidationError(errors)
+    return values
+
+
+def insert_rows(Response, fields, rows, on_insert=None):
+    """ Inserts the given rows (lists of python values in field order) with
+        one INSERT statement, in its own transaction. on_insert, if given,
+        is called inside the transaction, after the INSERT.
+    """
+    if not rows:
+        return
+    qn = connection.ops.quote_name
+    row_sql = '(%s)' % ', '.join(['%s'] * len(fields))
+    sql = 'INSERT INTO %s (%s) VALUES %s' % (
+        qn(Response._meta.db_table),
+        ', '.join(qn(f.column) for f in fields),
+        ', '.join([row_sql] * len(rows)))
+    params = [f.get_db_prep_save(value, connection=connection)
+                for row in rows for f, value in zip(fields, row)]
+
+    with transaction.commit_on_success():
+        connection.cursor().execute(sql, params)
+        responses_bulk_created.send(sender=Response, fields=fields, rows=rows)
+        if on_insert is not None:
+            on_insert()
+
+
+def read_lines(stream, length, block_size=64 * 1024):
+    """ Yields each line of the first length bytes of a file-like object
+        (eg. a request), reading a block at a time.
+    """
+    pending = ''
+    while length > 0:
+        block = stream.read(min(block_size, length))
+        if not block:
+            break
+        length -= len(block)
+        lines = (pending + block).split('\n')
+        pending = lines.pop()
+        for line in lines:
+            yield line + '\n'
+    if pending:
+        yield pending
+
+
+def read_jsonl(lines):
+    """ Yields the parsed value of each line of JSON in the given iterable,
+        or None if the line could not be parsed. Blank lines are skipped.
+    """
+    for line in lines:
+        line = line.strip()
+        if not line:
+            continue
+        try:
+            yield simplejson.loads(line)
+        except ValueError:
+            yield None
+
+
+def read_csv(lines):
+    """ Yields a dict for each row of UTF-8 CSV, where the first row names
+        the fields, or None if the row is not valid UTF-8 or has more values
+        than there are names.
+    """
+    for row in csv.DictReader(lines):
+        try:
+            if None in row:
+                raise ValueError
+            row = dict((k.decode('utf-8'), v.decode('utf-8')) for k, v in row.items() if v is not None)
+        except (UnicodeDecodeError, ValueError):
+            row = None
+        yield row
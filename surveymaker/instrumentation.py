@@ -0,0 +1,227 @@
+# -*- coding: UTF-8 -*-
+""" Timings and counts of the dynamic model machinery: model cache outcomes,
+    model generation, schema changes, admin registration and change
+    notification, tagged with the survey they were for.
+
+    Measurements are sent to the sink chosen with SURVEYMAKER_METRICS_SINK,
+    the dotted path of one of the classes below (or your own), created with
+    the keyword arguments in SURVEYMAKER_METRICS_OPTIONS. More sinks can be
+    added with add_sink(). Without any sinks, nothing is measured.
+"""
+
+from contextlib import contextmanager
+from functools import wraps
+import logging
+import socket
+import threading
+import time
+
+from django.utils.importlib import import_module
+
+from . import app_settings
+
+logger = logging.getLogger('surveymaker.metrics')
+
+
+class BaseSink(object):
+    """ Receives measurements. tags is a dict of strings, eg. {'survey': 'test'} """
+
+    def timing(self, name, seconds, tags):
+        raise NotImplementedError
+
+    def incr(self, name, value, tags):
+        raise NotImplementedError
+
+
+class LoggingSink(BaseSink):
+    """ Logs each measurement to the surveymaker.metrics logger. """
+
+    def __init__(self, level=logging.DEBUG):
+        self.level = level
+
+    def timing(self, name, seconds, tags):
+        logger.log(self.level, "%s took %.1fms %s" % (name, seconds * 1000, _format_tags(tags)))
+
+    def incr(self, name, value, tags):
+        logger.log(self.level, "%s +%d %s" % (name, value, _format_tags(tags)))
+
+
+class StatsdSink(BaseSink):
+    """ Sends measurements to a statsd server over UDP. Tags are sent in the
+        DogStatsD format, or (with tags_in_name) added to the metric's name.
+    """
+
+    def __init__(self, host='localhost', port=8125, prefix='surveymaker', tags_in_name=False):
+        self.address = (host, port)
+        self.prefix = prefix
+        self.tags_in_name = tags_in_name
+        self.socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+
+    def timing(self, name, seconds, tags):
+        self._send(name, '%d|ms' % round(seconds * 1000), tags)
+
+    def incr(self, name, value, tags):
+        self._send(name, '%d|c' % value, tags)
+
+    def _send(self, name, value, tags):
+        name = '%s.%s' % (self.prefix, name) if self.prefix else name
+        if self.tags_in_name:
+            name = '.'.join([name] + [tags[key] for key in sorted(tags)])
+        packet = '%s:%s' % (name, value)
+        if tags and not self.tags_in_name:
+            packet += '|#' + ','.join('%s:%s' % (k, tags[k]) for k in sorted(tags))
+        try:
+            self.socket.sendto(packet.encode('utf-8'), self.address)
+        except socket.error:
+            pass
+
+
+class MemorySink(BaseSink):
+    """ Keeps every measurement, eg. for tests. """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.reset()
+
+    def timing(self, name, seconds, tags):
+        with self._lock:
+            self.timings.append((name, seconds, tags))
+
+    def incr(self, name, value, tags):
+        key = (name, tuple(sorted(tags.items())))
+        with self._lock:
+            self.counts[key] = self.counts.get(key, 0) + value
+
+    def get_count(self, name, **tags):
+        """ The total of the given counter, for measurements with (at least)
+            the given tags.
+        """
+        return sum(value for (key_name, key_tags), value in self.counts.items()
+                    if key_name == name and set(tags.items()) <= set(key_tags))
+
+    def reset(self):
+        self.timings = []
+        self.counts = {}
+
+
+class RequestProfileSink(BaseSink):
+    """ Collects the measurements made in the current thread between
+        start() and stop(), eg. for a single request.
+    """
+
+    def __init__(self):
+        self._local = threading.local()
+
+    def start(self):
+        self._local.profile = {'counts': {}, 'intervals': []}
+
+    def stop(self):
+        """ Returns the counts (by name) and timings (the number and total
+            duration, by name) collected since start(), and the time spent
+            in any measured code (not counting nested measurements twice).
+        """
+        profile, self._local.profile = getattr(self._local, 'profile', None), None
+        if profile is None:
+            return None
+
+        timings = {}
+        busy = 0.0
+        busy_until = None
+        for started, finished, name in sorted(profile['intervals']):
+            count, total = timings.get(name, (0, 0.0))
+            timings[name] = (count + 1, total + finished - started)
+            if busy_until is None or started >= busy_until:
+                busy += finished - started
+                busy_until = finished
+            elif finished > busy_until:
+                busy += finished - busy_until
+                busy_until = finished
+        return {'counts': profile['counts'], 'timings': timings, 'seconds': busy}
+
+    def timing(self, name, seconds, tags):
+        profile = getattr(self._local, 'profile', None)
+        if profile is not None:
+            finished = time.time()
+            profile['intervals'].append((finished - seconds, finished, name))
+
+    def incr(self, name, value, tags):
+        profile = getattr(self._local, 'profile', None)
+        if profile is not None:
+            profile['counts'][name] = profile['counts'].get(name, 0) + value
+
+
+_sinks = []
+
+
+def add_sink(sink):
+    _sinks.append(sink)
+
+
+def remove_sink(sink):
+    if sink in _sinks:
+        _sinks.remove(sink)
+
+
+def incr(name, value=1, **tags):
+    for sink in _sinks:
+        sink.incr(name, value, tags)
+
+
+def incr_for_model(name, model, value=1):
+    """ Counts something that happened to the given response model (or
+        model name), tagged with its survey.
+    """
+    if _sinks:
+        incr(name, value, **model_tags(model))
+
+
+def timing(name, seconds, **tags):
+    for sink in _sinks:
+        sink.timing(name, seconds, tags)
+
+
+@contextmanager
+def timer(name, **tags):
+    """ Measures how long the block takes. """
+    if not _sinks:
+        yield
+        return
+    started = time.time()
+    try:
+        yield
+    finally:
+        timing(name, time.time() - started, **tags)
+
+
+def timed(name, get_tags=None):
+    """ A decorator that measures how long each call of a function takes.
+        get_tags is called with the function's arguments and returns the
+        measurement's tags.
+    """
+    def decorator(function):
+        @wraps(function)
+        def wrapper(*args, **kwargs):
+            if not _sinks:
+                return function(*args, **kwargs)
+            tags = get_tags(*args, **kwargs) if get_tags is not None else {}
+            with timer(name, **tags):
+                return function(*args, **kwargs)
+        return wrapper
+    return decorator
+
+
+def model_tags(model, *args, **kwargs):
+    """ Tags a measurement with the survey of the given response model (or
+        model name).
+    """
+    model_name = model if isinstance(model, basestring) else model._meta.object_name
+    return {'survey': model_name[len('Response'):] if model_name.startswith('Response') else model_name}
+
+
+def _format_tags(tags):
+    return ' '.join('%s=%s' % (k, tags[k]) for k in sorted(tags))
+
+
+if app_settings.METRICS_SINK:
+    module_name, class_name = app_settings.METRICS_SINK.rsplit('.', 1)
+    add_sink(getattr(import_module(module_name), class_name)(**app_settings.METRICS_OPTIONS))
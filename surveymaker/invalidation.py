@@ -0,0 +1,132 @@
+# -*- coding: UTF-8 -*-
+""" Transports that broadcast dynamic model changes to every process, so that
+    they can drop their outdated models straight away, instead of keeping
+    them until they next see the survey.
+
+    The transport is chosen with SURVEYMAKER_INVALIDATION_TRANSPORT, which is
+    the dotted path of one of the classes below (or your own), and
+    SURVEYMAKER_INVALIDATION_OPTIONS, the keyword arguments it is given.
+"""
+
+import logging
+import os
+import threading
+import time
+
+from django.utils import simplejson
+from django.utils.importlib import import_module
+
+from . import app_settings
+
+logger = logging.getLogger('surveymaker')
+
+
+class BaseTransport(object):
+    """ Publishes events (dicts) to, and receives events from, every process
+        using the same transport.
+    """
+
+    def publish(self, event):
+        raise NotImplementedError
+
+    def listen(self, callback):
+        """ Calls callback with each event received, blocking forever. """
+        raise NotImplementedError
+
+    def start(self, callback):
+        """ Listens for events in a background thread. """
+        thread = threading.Thread(target=self._listen_forever, args=(callback,),
+                                  name='surveymaker-invalidation')
+        thread.daemon = True
+        thread.start()
+        return thread
+
+    def _listen_forever(self, callback):
+        while True:
+            try:
+                self.listen(callback)
+            except Exception:
+                logger.exception("Lost connection to the model invalidation transport, reconnecting")
+                time.sleep(1)
+
+
+class FileTransport(BaseTransport):
+    """ Appends events to a file, which every process polls.
+        Only suitable for processes on the same machine, eg. for testing.
+    """
+
+    def __init__(self, path, poll_interval=1.0):
+        self.path = path
+        self.poll_interval = poll_interval
+
+    def publish(self, event):
+        # Short appends are atomic, so processes won't interleave their events
+        f = open(self.path, 'a')
+        try:
+            f.write(simplejson.dumps(event) + '\n')
+        finally:
+            f.close()
+
+    def listen(self, callback):
+        # Only events published from now on are relevant
+        position = os.path.exists(self.path) and os.path.getsize(self.path) or 0
+        while True:
+            if os.path.exists(self.path) and os.path.getsize(self.path) > position:
+                f = open(self.path)
+                try:
+                    f.seek(position)
+                    for line in iter(f.readline, ''):
+                        # Leave any partly written line until next time
+                        if not line.endswith('\n'):
+                            break
+                        position += len(line)
+                        callback(simplejson.loads(line))
+                finally:
+                    f.close()
+            time.sleep(self.poll_interval)
+
+
+class RedisTransport(BaseTransport):
+    """ Uses Redis publish/subscribe. Any other options are passed to redis.Redis """
+
+    def __init__(self, channel='surveymaker_model_changes', **options):
+        import redis
+        self.channel = channel
+        self.client = redis.Redis(**options)
+
+    def publish(self, event):
+        self.client.publish(self.channel, simplejson.dumps(event))
+
+    def listen(self, callback):
+        pubsub = self.client.pubsub()
+        pubsub.subscribe(self.channel)
+        for message in pubsub.listen():
+            if message['type'] == 'message':
+                callback(simplejson.loads(message['data']))
+
+
+_transport = None
+_listener = None
+
+
+def get_transport():
+    """ Returns the configured transport, or None if there isn't one. """
+    global _transport
+    if _transport is None and app_settings.INVALIDATION_TRANSPORT:
+        module_name, class_name = app_settings.INVALIDATION_TRANSPORT.rsplit('.', 1)
+        transport_class = getattr(import_module(module_name), class_name)
+        _transport = transport_class(**app_settings.INVALIDATION_OPTIONS)
+    return _transport
+
+
+def start_listening(callback):
+    """ Starts passing received events to callback, once per process.
+        Returns False if there is no transport to listen to.
+    """
+    global _listener
+    transport = get_transport()
+    if transport is None:
+        return False
+    if _listener is None:
+        _listener = transport.start(callback)
+    return True
@@ -0,0 +1,38 @@
+# -*- coding: UTF-8 -*-
+from optparse import make_option
+import time
+
+from django.core.management.base import BaseCommand
+
+from surveymaker import schema_changes
+from surveymaker.models import PendingSchemaChange
+
+
+class Command(BaseCommand):
+    help = "Makes the pending changes to response tables (see SURVEYMAKER_ONLINE_SCHEMA_CHANGES)."
+    option_list = BaseCommand.option_list + (
+        make_option('--interval', type='float', default=None,
+            help='Keep running, checking for changes every this many seconds.'),
+        make_option('--retry', action='store_true', default=False,
+            help='Try failed changes again.'),
+        make_option('--reclaim', type='float', default=None,
+            help='Try changes again whose worker has not reported progress for this many '
+                 'seconds, eg. because the process making them died.'),
+        )
+
+    def handle(self, *args, **options):
+        if options['retry']:
+            PendingSchemaChange.objects.filter(status=schema_changes.FAILED).update(
+                status=schema_changes.PENDING, error="")
+
+        while True:
+            if options['reclaim'] is not None:
+                reclaimed = schema_changes.reclaim_stale_changes(options['reclaim'])
+                if reclaimed:
+                    self.stdout.write("Reclaimed %d stale schema changes.\n" % reclaimed)
+            applied = schema_changes.apply_pending_changes()
+            if applied:
+                self.stdout.write("Made %d schema changes.\n" % applied)
+            if options['interval'] is None:
+                break
+            time.sleep(options['interval'])
@@ -0,0 +1,33 @@
+# -*- coding: UTF-8 -*-
+from optparse import make_option
+
+from django.core.management.base import BaseCommand, CommandError
+
+from surveymaker.export import EXPORT_FORMATS
+from surveymaker.models import Survey
+
+
+class Command(BaseCommand):
+    args = '<survey_slug>'
+    help = "Writes all of a survey's responses to stdout, as CSV or JSON lines."
+    option_list = BaseCommand.option_list + (
+        make_option('--format', default='csv',
+            help='The output format: %s' % ', '.join(sorted(EXPORT_FORMATS))),
+        make_option('--chunk-size', type='int', default=None, dest='chunk_size',
+            help='The number of responses to fetch with each query.'),
+        )
+
+    def handle(self, *args, **options):
+        if len(args) != 1:
+            raise CommandError("Please give the slug of one survey.")
+        try:
+            survey = Survey.objects.get(slug=args[0])
+        except Survey.DoesNotExist:
+            raise CommandError("There is no survey '%s'." % args[0])
+        try:
+            export, mimetype = EXPORT_FORMATS[options['format']]
+        except KeyError:
+            raise CommandError("Unknown format '%s'." % options['format'])
+
+        for data in export(survey.Response, options['chunk_size']):
+            self.stdout.write(data)
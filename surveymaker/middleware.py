@@ -0,0 +1,90 @@
+# -*- coding: UTF-8 -*-
+import time
+
+from django.core.exceptions import MiddlewareNotUsed
+
+from . import app_settings
+from . import instrumentation
+from . import signals
+from . import utils
+
+
+class AdminBatchMiddleware(object):
+    """ Reloads the URL conf at most once per request, no matter how many
+        dynamic models are (re)registered in the admin during the request.
+        If another middleware's process_response raises, this one's isn't
+        called, so the batch is ended when the view raises too, and any
+        batch still open is ended when the next request starts.
+    """
+
+    def process_request(self, request):
+        utils.reset_admin_batch()
+        utils.start_admin_batch()
+
+    def process_exception(self, request, exception):
+        utils.end_admin_batch()
+
+    def process_response(self, request, response):
+        utils.end_admin_batch()
+        return response
+
+
+class SchemaBatchMiddleware(object):
+    """ Updates each survey's table and model at most once per request, no
+        matter how many of its questions are saved during the request.
+        This should come after AdminBatchMiddleware, so that the admin
+        changes it makes are batched too.
+    """
+
+    def process_request(self, request):
+        # As with AdminBatchMiddleware, a batch could have been left open
+        signals.reset_schema_batch()
+        signals.start_schema_batch()
+
+    def process_exception(self, request, exception):
+        signals.end_schema_batch()
+
+    def process_response(self, request, response):
+        signals.end_schema_batch()
+        return response
+
+
+class ProfileMiddleware(object):
+    """ Adds headers to each response, showing how much work the dynamic
+        models took during the request: how many models were looked up and
+        built, how many times the shared cache and the database catalog were
+        consulted, and the time (in milliseconds) this took, compared with
+        the whole request. Only used when SURVEYMAKER_PROFILE_REQUESTS is set.
+        This should come first, so that the other middleware is included.
+    """
+
+    def __init__(self):
+        if not app_settings.PROFILE_REQUESTS:
+            raise MiddlewareNotUsed
+        self.sink = instrumentation.RequestProfileSink()
+        instrumentation.add_sink(self.sink)
+
+    def process_request(self, request):
+        request._surveymaker_started = time.time()
+        self.sink.start()
+
+    def process_response(self, request, response):
+        profile = self.sink.stop()
+        started = getattr(request, '_surveymaker_started', None)
+        if profile is None or started is None:
+            return response
+        counts, timings = profile['counts'], profile['timings']
+
+        # A coalesced lookup was already counted as a miss (or stale) before
+        # it waited for the model another thread was building
+        response['X-Surveymaker-Model-Lookups'] = sum(
+            count for name, count in counts.items()
+            if name.startswith('model_cache.') and name != 'model_cache.coalesced')
+        response['X-Surveymaker-Models-Built'] = timings.get('model.build', (0, 0))[0]
+        response['X-Surveymaker-Cache-Round-Trips'] = (
+            counts.get('shared_cache.get', 0) + counts.get('shared_cache.set', 0))
+        response['X-Surveymaker-Introspections'] = timings.get('schema.introspect', (0, 0))[0]
+        response['X-Surveymaker-Time'] = '%.1f' % (profile['seconds'] * 1000)
+        response['X-Surveymaker-Request-Time'] = '%.1f' % (
+            (time.time() - started) * 1000)
+        return response
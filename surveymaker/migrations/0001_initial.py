@@ -0,0 +1,67 @@
+# -*- coding: utf-8 -*-
+import datetime
+from south.db import db
+from south.v2 import SchemaMigration
+from django.db import models
+
+
+class Migration(SchemaMigration):
+
+    def forwards(self, orm):
+        # Adding model 'Survey'
+        db.create_table('surveymaker_survey', (
+            ('id', self.gf('django.db.models.fields.AutoField')(primary_key=True)),
+            ('name', self.gf('django.db.models.fields.CharField')(default='', max_length=255)),
+            ('slug', self.gf('django.db.models.fields.SlugField')(unique=True, max_length=50)),
+        ))
+        db.send_create_signal('surveymaker', ['Survey'])
+
+        # Adding model 'Question'
+        db.create_table('surveymaker_question', (
+            ('id', self.gf('django.db.models.fields.AutoField')(primary_key=True)),
+            ('survey', self.gf('django.db.models.fields.related.ForeignKey')(to=orm['surveymaker.Survey'])),
+            ('question', self.gf('django.db.models.fields.CharField')(default='', max_length=255)),
+            ('slug', self.gf('django.db.models.fields.SlugField')(max_length=50)),
+            ('answer_type', self.gf('django.db.models.fields.CharField')(max_length=32)),
+            ('choices', self.gf('django.db.models.fields.CharField')(default='', max_length=1024, blank=True)),
+            ('required', self.gf('django.db.models.fields.BooleanField')(default=False)),
+            ('rank', self.gf('django.db.models.fields.PositiveIntegerField')(default=5)),
+        ))
+        db.send_create_signal('surveymaker', ['Question'])
+
+        # Adding unique constraint on 'Question', fields ['survey', 'slug']
+        db.create_unique('surveymaker_question', ['survey_id', 'slug'])
+
+
+    def backwards(self, orm):
+        # Removing unique constraint on 'Question', fields ['survey', 'slug']
+        db.delete_unique('surveymaker_question', ['survey_id', 'slug'])
+
+        # Deleting model 'Survey'
+        db.delete_table('surveymaker_survey')
+
+        # Deleting model 'Question'
+        db.delete_table('surveymaker_question')
+
+
+    models = {
+        'surveymaker.question': {
+            'Meta': {'ordering': "['rank']", 'unique_together': "(['survey', 'slug'],)", 'object_name': 'Question'},
+            'answer_type': ('django.db.models.fields.CharField', [], {'max_length': '32'}),
+            'choices': ('django.db.models.fields.CharField', [], {'default': "''", 'max_length': '1024', 'blank': 'True'}),
+            'id': ('django.db.models.fields.AutoField', [], {'primary_key': 'True'}),
+            'question': ('django.db.models.fields.CharField', [], {'default': "''", 'max_length': '255'}),
+            'rank': ('django.db.models.fields.PositiveIntegerField', [], {'default': '5'}),
+            'required': ('django.db.models.fields.BooleanField', [], {'default': 'False'}),
+            'slug': ('django.db.models.fields.SlugField', [], {'max_length': '50'}),
+            'survey': ('django.db.models.fields.related.ForeignKey', [], {'to': "orm['surveymaker.Survey']"})
+        },
+        'surveymaker.survey': {
+            'Meta': {'object_name': 'Survey'},
+            'id': ('django.db.models.fields.AutoField', [], {'primary_key': 'True'}),
+            'name': ('django.db.models.fields.CharField', [], {'default': "''", 'max_length': '255'}),
+            'slug': ('django.db.models.fields.SlugField', [], {'unique': 'True', 'max_length': '50'})
+        }
+    }
+
+    complete_apps = ['surveymaker']
\ No newline at end of file
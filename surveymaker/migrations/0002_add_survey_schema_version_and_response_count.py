@@ -0,0 +1,52 @@
+# -*- coding: utf-8 -*-
+import datetime
+from south.db import db
+from south.v2 import SchemaMigration
+from django.db import models
+
+
+class Migration(SchemaMigration):
+
+    def forwards(self, orm):
+        # Adding field 'Survey.schema_version'
+        db.add_column('surveymaker_survey', 'schema_version',
+                      self.gf('django.db.models.fields.PositiveIntegerField')(default=0, db_index=True),
+                      keep_default=False)
+
+        # Adding field 'Survey.response_count'
+        db.add_column('surveymaker_survey', 'response_count',
+                      self.gf('django.db.models.fields.PositiveIntegerField')(default=0),
+                      keep_default=False)
+
+
+    def backwards(self, orm):
+        # Deleting field 'Survey.schema_version'
+        db.delete_column('surveymaker_survey', 'schema_version')
+
+        # Deleting field 'Survey.response_count'
+        db.delete_column('surveymaker_survey', 'response_count')
+
+
+    models = {
+        'surveymaker.question': {
+            'Meta': {'ordering': "['rank']", 'unique_together': "(['survey', 'slug'],)", 'object_name': 'Question'},
+            'answer_type': ('django.db.models.fields.CharField', [], {'max_length': '32'}),
+            'choices': ('django.db.models.fields.CharField', [], {'default': "''", 'max_length': '1024', 'blank': 'True'}),
+            'id': ('django.db.models.fields.AutoField', [], {'primary_key': 'True'}),
+            'question': ('django.db.models.fields.CharField', [], {'default': "''", 'max_length': '255'}),
+            'rank': ('django.db.models.fields.PositiveIntegerField', [], {'default': '5'}),
+            'required': ('django.db.models.fields.BooleanField', [], {'default': 'False'}),
+            'slug': ('django.db.models.fields.SlugField', [], {'max_length': '50'}),
+            'survey': ('django.db.models.fields.related.ForeignKey', [], {'to': "orm['surveymaker.Survey']"})
+        },
+        'surveymaker.survey': {
+            'Meta': {'object_name': 'Survey'},
+            'id': ('django.db.models.fields.AutoField', [], {'primary_key': 'True'}),
+            'name': ('django.db.models.fields.CharField', [], {'default': "''", 'max_length': '255'}),
+            'response_count': ('django.db.models.fields.PositiveIntegerField', [], {'default': '0'}),
+            'schema_version': ('django.db.models.fields.PositiveIntegerField', [], {'default': '0', 'db_index': 'True'}),
+            'slug': ('django.db.models.fields.SlugField', [], {'unique': 'True', 'max_length': '50'})
+        }
+    }
+
+    complete_apps = ['surveymaker']
\ No newline at end of file
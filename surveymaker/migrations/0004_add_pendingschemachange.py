@@ -0,0 +1,73 @@
+# -*- coding: utf-8 -*-
+import datetime
+from south.db import db
+from south.v2 import SchemaMigration
+from django.db import models
+
+
+class Migration(SchemaMigration):
+
+    def forwards(self, orm):
+        # Adding model 'PendingSchemaChange'
+        db.create_table('surveymaker_pendingschemachange', (
+            ('id', self.gf('django.db.models.fields.AutoField')(primary_key=True)),
+            ('survey', self.gf('django.db.models.fields.related.ForeignKey')(to=orm['surveymaker.Survey'])),
+            ('question', self.gf('django.db.models.fields.related.ForeignKey')(to=orm['surveymaker.Question'])),
+            ('old_column', self.gf('django.db.models.fields.CharField')(default='', max_length=255, blank=True)),
+            ('status', self.gf('django.db.models.fields.CharField')(default='pending', max_length=16, db_index=True)),
+            ('error', self.gf('django.db.models.fields.TextField')(default='', blank=True)),
+            ('created', self.gf('django.db.models.fields.DateTimeField')(auto_now_add=True, blank=True)),
+            ('started', self.gf('django.db.models.fields.DateTimeField')(null=True, blank=True)),
+        ))
+        db.send_create_signal('surveymaker', ['PendingSchemaChange'])
+
+
+    def backwards(self, orm):
+        # Deleting model 'PendingSchemaChange'
+        db.delete_table('surveymaker_pendingschemachange')
+
+
+    models = {
+        'surveymaker.pendingschemachange': {
+            'Meta': {'object_name': 'PendingSchemaChange'},
+            'created': ('django.db.models.fields.DateTimeField', [], {'auto_now_add': 'True', 'blank': 'True'}),
+            'error': ('django.db.models.fields.TextField', [], {'default': "''", 'blank': 'True'}),
+            'id': ('django.db.models.fields.AutoField', [], {'primary_key': 'True'}),
+            'old_column': ('django.db.models.fields.CharField', [], {'default': "''", 'max_length': '255', 'blank': 'True'}),
+            'question': ('django.db.models.fields.related.ForeignKey', [], {'to': "orm['surveymaker.Question']"}),
+            'started': ('django.db.models.fields.DateTimeField', [], {'null': 'True', 'blank': 'True'}),
+            'status': ('django.db.models.fields.CharField', [], {'default': "'pending'", 'max_length': '16', 'db_index': 'True'}),
+            'survey': ('django.db.models.fields.related.ForeignKey', [], {'to': "orm['surveymaker.Survey']"})
+        },
+        'surveymaker.question': {
+            'Meta': {'ordering': "['rank']", 'unique_together': "(['survey', 'slug'],)", 'object_name': 'Question'},
+            'answer_type': ('django.db.models.fields.CharField', [], {'max_length': '32'}),
+            'choices': ('django.db.models.fields.CharField', [], {'default': "''", 'max_length': '1024', 'blank': 'True'}),
+            'id': ('django.db.models.fields.AutoField', [], {'primary_key': 'True'}),
+            'question': ('django.db.models.fields.CharField', [], {'default': "''", 'max_length': '255'}),
+            'rank': ('django.db.models.fields.PositiveIntegerField', [], {'default': '5'}),
+            'required': ('django.db.models.fields.BooleanField', [], {'default': 'False'}),
+            'slug': ('django.db.models.fields.SlugField', [], {'max_length': '50'}),
+            'survey': ('django.db.models.fields.related.ForeignKey', [], {'to': "orm['surveymaker.Survey']"})
+        },
+        'surveymaker.responsesummary': {
+            'Meta': {'unique_together': "(['question', 'choice'],)", 'object_name': 'ResponseSummary'},
+            'choice': ('django.db.models.fields.CharField', [], {'default': "''", 'max_length': '255', 'blank': 'True'}),
+            'count': ('django.db.models.fields.PositiveIntegerField', [], {'default': '0'}),
+            'id': ('django.db.models.fields.AutoField', [], {'primary_key': 'True'}),
+            'maximum': ('django.db.models.fields.DecimalField', [], {'null': 'True', 'max_digits': '24', 'decimal_places': '2'}),
+            'minimum': ('django.db.models.fields.DecimalField', [], {'null': 'True', 'max_digits': '24', 'decimal_places': '2'}),
+            'question': ('django.db.models.fields.related.ForeignKey', [], {'to': "orm['surveymaker.Question']"}),
+            'total': ('django.db.models.fields.DecimalField', [], {'null': 'True', 'max_digits': '24', 'decimal_places': '2'})
+        },
+        'surveymaker.survey': {
+            'Meta': {'object_name': 'Survey'},
+            'id': ('django.db.models.fields.AutoField', [], {'primary_key': 'True'}),
+            'name': ('django.db.models.fields.CharField', [], {'default': "''", 'max_length': '255'}),
+            'response_count': ('django.db.models.fields.PositiveIntegerField', [], {'default': '0'}),
+            'schema_version': ('django.db.models.fields.PositiveIntegerField', [], {'default': '0', 'db_index': 'True'}),
+            'slug': ('django.db.models.fields.SlugField', [], {'unique': 'True', 'max_length': '50'})
+        }
+    }
+
+    complete_apps = ['surveymaker']
\ No newline at end of file
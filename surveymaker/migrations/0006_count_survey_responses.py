@@ -0,0 +1,69 @@
+# -*- coding: utf-8 -*-
+import datetime
+from south.db import db
+from south.v2 import DataMigration
+from django.db import connection, models
+
+
+class Migration(DataMigration):
+
+    def forwards(self, orm):
+        "Counts the responses to each existing survey, which were counted as 0 when the column was added."
+        tables = set(connection.introspection.table_names())
+        for survey in orm.Survey.objects.all():
+            # The response table's name, as given by dynamic_models.get_response_table_name
+            table_name = 'responses_response' + filter(str.isalpha, survey.slug.encode('ascii', 'ignore')).lower()
+            if table_name in tables:
+                count = db.execute('SELECT COUNT(*) FROM %s' % db.quote_name(table_name))[0][0]
+                orm.Survey.objects.filter(pk=survey.pk).update(response_count=count)
+
+    def backwards(self, orm):
+        "Nothing to undo, the counts are kept."
+
+
+    models = {
+        'surveymaker.pendingschemachange': {
+            'Meta': {'object_name': 'PendingSchemaChange'},
+            'created': ('django.db.models.fields.DateTimeField', [], {'auto_now_add': 'True', 'blank': 'True'}),
+            'error': ('django.db.models.fields.TextField', [], {'default': "''", 'blank': 'True'}),
+            'id': ('django.db.models.fields.AutoField', [], {'primary_key': 'True'}),
+            'old_column': ('django.db.models.fields.CharField', [], {'default': "''", 'max_length': '255', 'blank': 'True'}),
+            'question': ('django.db.models.fields.related.ForeignKey', [], {'to': "orm['surveymaker.Question']"}),
+            'started': ('django.db.models.fields.DateTimeField', [], {'null': 'True', 'blank': 'True'}),
+            'status': ('django.db.models.fields.CharField', [], {'default': "'pending'", 'max_length': '16', 'db_index': 'True'}),
+            'survey': ('django.db.models.fields.related.ForeignKey', [], {'to': "orm['surveymaker.Survey']"})
+        },
+        'surveymaker.question': {
+            'Meta': {'ordering': "['rank']", 'unique_together': "(['survey', 'slug'],)", 'object_name': 'Question'},
+            'answer_type': ('django.db.models.fields.CharField', [], {'max_length': '32'}),
+            'choices': ('django.db.models.fields.CharField', [], {'default': "''", 'max_length': '1024', 'blank': 'True'}),
+            'id': ('django.db.models.fields.AutoField', [], {'primary_key': 'True'}),
+            'question': ('django.db.models.fields.CharField', [], {'default': "''", 'max_length': '255'}),
+            'rank': ('django.db.models.fields.PositiveIntegerField', [], {'default': '5'}),
+            'required': ('django.db.models.fields.BooleanField', [], {'default': 'False'}),
+            'slug': ('django.db.models.fields.SlugField', [], {'max_length': '50'}),
+            'survey': ('django.db.models.fields.related.ForeignKey', [], {'to': "orm['surveymaker.Survey']"})
+        },
+        'surveymaker.responsesummary': {
+            'Meta': {'unique_together': "(['question', 'choice'],)", 'object_name': 'ResponseSummary'},
+            'choice': ('django.db.models.fields.CharField', [], {'default': "''", 'max_length': '255', 'blank': 'True'}),
+            'count': ('django.db.models.fields.PositiveIntegerField', [], {'default': '0'}),
+            'id': ('django.db.models.fields.AutoField', [], {'primary_key': 'True'}),
+            'maximum': ('django.db.models.fields.DecimalField', [], {'null': 'True', 'max_digits': '24', 'decimal_places': '2'}),
+            'minimum': ('django.db.models.fields.DecimalField', [], {'null': 'True', 'max_digits': '24', 'decimal_places': '2'}),
+            'question': ('django.db.models.fields.related.ForeignKey', [], {'to': "orm['surveymaker.Question']"}),
+            'total': ('django.db.models.fields.DecimalField', [], {'null': 'True', 'max_digits': '24', 'decimal_places': '2'})
+        },
+        'surveymaker.survey': {
+            'Meta': {'object_name': 'Survey'},
+            'id': ('django.db.models.fields.AutoField', [], {'primary_key': 'True'}),
+            'model_hash': ('django.db.models.fields.CharField', [], {'default': "''", 'max_length': '32'}),
+            'name': ('django.db.models.fields.CharField', [], {'default': "''", 'max_length': '255'}),
+            'response_count': ('django.db.models.fields.PositiveIntegerField', [], {'default': '0'}),
+            'schema_version': ('django.db.models.fields.PositiveIntegerField', [], {'default': '0', 'db_index': 'True'}),
+            'slug': ('django.db.models.fields.SlugField', [], {'unique': 'True', 'max_length': '50'})
+        }
+    }
+
+    complete_apps = ['surveymaker']
+    symmetrical = True
\ No newline at end of file
@@ -1,10 +1,11 @@
 # -*- coding: UTF-8 -*-
 
 from django.core.exceptions import ValidationError
+from django.core.signals import request_started
 from django.db import models
 from django.db.models.signals import post_save, pre_save, pre_delete, post_delete
-from django.utils import simplejson
 
+from . import app_settings
 from . import fields
 from . import utils
 from . import signals
@@ -13,14 +14,24 @@ from .dynamic_models import get_survey_response_model, build_existing_survey_res
 
 # Build all existing survey response models as soon as possible
 # This is optional, but is nice as it avoids building the model when the
-# first relevant view is loaded.
-utils.when_classes_prepared('surveymaker', ['Survey', 'Question'], 
+# first relevant view is loaded. With many surveys, it can be better to
+# build each model lazily, when it is first used.
+if not app_settings.LAZY_MODELS:
+    utils.when_classes_prepared('surveymaker', ['Survey', 'Question'], 
                                 build_existing_survey_response_models)
 
+# Hear about changes made by other processes as soon as they happen, from
+# the first request on
+request_started.connect(utils.start_invalidation_listener)
+
 
 class Survey(models.Model):
     name = models.CharField(max_length=255, default="")
     slug = models.SlugField(unique=True)
+    schema_version = models.PositiveIntegerField(default=0, db_index=True, editable=False)
+    response_count = models.PositiveIntegerField(default=0, editable=False)
+    # The hash of the last response model the survey's table was checked for
+    model_hash = models.CharField(max_length=32, default="", editable=False)
 
     def __unicode__(self):
         return self.name
@@ -39,13 +50,27 @@ class Survey(models.Model):
     def get_survey_response_model(self, regenerate=False, notify_changes=True):
         return get_survey_response_model(self, regenerate=regenerate, notify_changes=notify_changes)
 
-    def get_hash_string(self):
-        """ Return a string to describe the parts of the questions that are
-            relevant to the generated dynamic model (the Response model)
+    def bump_schema_version(self):
+        """ Record that the questions (and therefore the response model) have
+            changed, so that other processes know to regenerate their model.
+        """
+        surveys = Survey.objects.filter(pk=self.pk)
+        surveys.update(schema_version=models.F('schema_version') + 1)
+        self.schema_version = surveys.values_list('schema_version', flat=True).get()
+
+    def get_response_aggregates(self):
+        if app_settings.RESPONSE_SUMMARIES:
+            from .summaries import get_summaries
+            return get_summaries(self)
+        from .aggregates import get_response_aggregates
+        return get_response_aggregates(self)
+
+    def update_response_count(self):
+        """ Counts the responses in the database, in case response_count is
+            wrong (eg. after responses were added by hand).
         """
-        # Only use the fields that are relevant
-        val = [(q.slug, q.required, q.question, q.choices, q.rank) for q in self.question_set.all()]
-        return simplejson.dumps(val)
+        self.response_count = self.Response.objects.count()
+        Survey.objects.filter(pk=self.pk).update(response_count=self.response_count)
 
 
 class Question(models.Model):
@@ -81,10 +106,49 @@ class Question(models.Model):
         unique_together = ['survey', 'slug']
 
 
+class ResponseSummary(models.Model):
+    """ Running totals of the answers to a question, kept when
+        SURVEYMAKER_RESPONSE_SUMMARIES is set. Questions with choices have
+        a row for each choice, numeric questions have a single row.
+    """
+    question = models.ForeignKey(Question)
+    choice   = models.CharField(max_length=255, default="", blank=True)
+    count    = models.PositiveIntegerField(default=0)
+    total    = models.DecimalField(max_digits=24, decimal_places=2, null=True)
+    minimum  = models.DecimalField(max_digits=24, decimal_places=2, null=True)
+    maximum  = models.DecimalField(max_digits=24, decimal_places=2, null=True)
+
+    class Meta:
+        unique_together = ['question', 'choice']
+
+
+class PendingSchemaChange(models.Model):
+    """ A column to be added to (or renamed in) a response table in the
+        background, when SURVEYMAKER_ONLINE_SCHEMA_CHANGES is set.
+        The question's answers are in old_column until then, if it has one.
+    """
+    STATUSES = (
+        ('pending', 'Pending'),
+        ('running', 'Running'),
+        ('failed', 'Failed'),
+        )
+    survey     = models.ForeignKey(Survey)
+    question   = models.ForeignKey(Question)
+    old_column = models.CharField(max_length=255, default="", blank=True)
+    status     = models.CharField(max_length=16, choices=STATUSES, default='pending', db_index=True)
+    error      = models.TextField(default="", blank=True)
+    created    = models.DateTimeField(auto_now_add=True)
+    started    = models.DateTimeField(null=True, blank=True)
+
+
 # Connect signals
 pre_save.connect(signals.question_pre_save, sender=Question)
 post_save.connect(signals.question_post_save, sender=Question)
 post_delete.connect(signals.question_post_delete, sender=Question)
 post_save.connect(signals.survey_post_save, sender=Survey)
 pre_delete.connect(signals.survey_pre_delete, sender=Survey)
+pre_save.connect(signals.response_pre_save)
+post_save.connect(signals.response_post_save)
+post_delete.connect(signals.response_post_delete)
+signals.responses_bulk_created.connect(signals.responses_bulk_saved)
 
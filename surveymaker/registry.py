@@ -0,0 +1,98 @@
+# -*- coding: UTF-8 -*-
+""" A per-process record of the dynamic models that have been generated:
+    the current model of each survey, so that it can be found without any
+    shared cache lookups, and which models were used most recently, to limit
+    how many models each process keeps.
+"""
+
+from collections import OrderedDict
+import threading
+
+from . import app_settings
+
+
+class ModelRegistry(object):
+    """ The response model this process generated for each survey, by survey
+        id, along with the schema version it was generated for.
+        Looking up a survey's model is a dictionary lookup, and a comparison
+        with the schema version the survey was loaded with (so once per
+        request, for surveys loaded in each request). Models are dropped when
+        another process announces a newer version (see
+        utils.handle_model_change), or when they are evicted.
+    """
+
+    def __init__(self):
+        self._models = {}
+        self._lock = threading.Lock()
+
+    def get(self, survey_id, version):
+        """ Returns the survey's model if it was generated for the given
+            schema version, otherwise None.
+        """
+        model = self._models.get(survey_id)
+        if model is not None and model._schema_version == version:
+            return model
+        return None
+
+    def add(self, model):
+        with self._lock:
+            self._models[model._survey_id] = model
+
+    def discard(self, model):
+        """ Forgets the given model, unless it has already been replaced. """
+        with self._lock:
+            if self._models.get(model._survey_id) is model:
+                del self._models[model._survey_id]
+
+
+class ModelLRU(object):
+    """ Tracks which dynamic models have been used most recently, so that
+        no more than max_size are kept. None means there is no limit.
+    """
+
+    def __init__(self, max_size=None):
+        self.max_size = max_size
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._models = OrderedDict()
+        self._lock = threading.Lock()
+
+    def hit(self, app_label, model_name):
+        """ Records that a model was used. """
+        key = (app_label, model_name.lower())
+        with self._lock:
+            self.hits += 1
+            if key in self._models:
+                self._models[key] = self._models.pop(key)
+
+    def miss(self, app_label, model_name):
+        """ Records that a model had to be generated. """
+        with self._lock:
+            self.misses += 1
+
+    def add(self, app_label, model_name):
+        """ Adds a newly generated model, returning the (app_label, model_name)
+            of any models that should now be evicted.
+        """
+        key = (app_label, model_name.lower())
+        evicted = []
+        with self._lock:
+            self._models.pop(key, None)
+            self._models[key] = True
+            while self.max_size is not None and len(self._models) > self.max_size:
+                evicted.append(self._models.popitem(last=False)[0])
+            self.evictions += len(evicted)
+        return evicted
+
+    def discard(self, app_label, model_name):
+        with self._lock:
+            self._models.pop((app_label, model_name.lower()), None)
+
+    def get_stats(self):
+        return {'size': len(self._models), 'max_size': self.max_size,
+                'hits': self.hits, 'misses': self.misses, 'evictions': self.evictions}
+
+
+registry = ModelRegistry()
+lru = ModelLRU(max_size=app_settings.MODEL_CACHE_SIZE)
@@ -0,0 +1,128 @@
+# -*- coding: UTF-8 -*-
+""" Reads the tables and columns of the dynamic models from the database
+    catalog with a single query, so that many tables can be checked without
+    introspecting each one separately.
+"""
+
+from contextlib import contextmanager
+import sqlite3
+import threading
+
+from django.db import connection
+
+from . import instrumentation
+
+
+# The prefix shared by all dynamic model tables
+TABLE_PREFIX = 'responses_'
+
+# Queries returning (table name, column name) for tables matching a LIKE pattern
+CATALOG_QUERIES = {
+    'postgresql': "SELECT table_name, column_name FROM information_schema.columns "
+                  "WHERE table_schema = current_schema() AND table_name LIKE %s",
+    'mysql':      "SELECT table_name, column_name FROM information_schema.columns "
+                  "WHERE table_schema = DATABASE() AND table_name LIKE %s",
+    'sqlite':     "SELECT m.name, p.name FROM sqlite_master m, pragma_table_info(m.name) p "
+                  "WHERE m.type = 'table' AND m.name LIKE %s",
+    }
+
+_local = threading.local()
+
+
+class SchemaSnapshot(object):
+    """ The tables (and their columns) whose names start with the given
+        prefix, as they currently exist in the database.
+        DDL run through utils keeps the snapshot up to date.
+    """
+
+    def __init__(self, prefix=TABLE_PREFIX):
+        self.prefix = prefix
+        self.tables = read_tables(prefix)
+
+    def covers(self, table_name):
+        return self._convert(table_name).startswith(self._convert(self.prefix))
+
+    def has_table(self, table_name):
+        return self._convert(table_name) in self.tables
+
+    def get_columns(self, table_name):
+        return self.tables.get(self._convert(table_name), set())
+
+    def add_table(self, table_name, columns):
+        self.tables[self._convert(table_name)] = set(columns)
+
+    def add_column(self, table_name, column):
+        self.tables.setdefault(self._convert(table_name), set()).add(column)
+
+    def rename_column(self, table_name, old_name, new_name):
+        columns = self.tables.setdefault(self._convert(table_name), set())
+        columns.discard(old_name)
+        columns.add(new_name)
+
+    def remove_table(self, table_name):
+        self.tables.pop(self._convert(table_name), None)
+
+    def _convert(self, table_name):
+        return connection.introspection.table_name_converter(table_name)
+
+
+@instrumentation.timed('schema.introspect')
+def read_tables(prefix):
+    """ Returns a dict of table name to a set of its column names, for every
+        table whose name starts with the given prefix.
+    """
+    converter = connection.introspection.table_name_converter
+    prefix = converter(prefix)
+    cursor = connection.cursor()
+    tables = {}
+
+    query = _get_catalog_query()
+    if query is not None:
+        # NB underscores are wildcards in LIKE, so the prefix is checked again below
+        cursor.execute(query, [prefix + '%'])
+        for table_name, column_name in cursor.fetchall():
+            table_name = converter(table_name)
+            if table_name.startswith(prefix):
+                tables.setdefault(table_name, set()).add(column_name)
+        return tables
+
+    # Otherwise introspect each matching table
+    for table_name in connection.introspection.table_names():
+        if table_name.startswith(prefix):
+            tables[table_name] = set(row[0] for row in
+                connection.introspection.get_table_description(cursor, table_name))
+    return tables
+
+
+def _get_catalog_query():
+    engine = connection.settings_dict['ENGINE']
+    # pragma_table_info can only be joined from SQLite 3.16
+    if 'sqlite' in engine and sqlite3.sqlite_version_info < (3, 16):
+        return None
+    for vendor, query in CATALOG_QUERIES.items():
+        if vendor in engine:
+            return query
+    return None
+
+
+def get_current_snapshot():
+    return getattr(_local, 'snapshot', None)
+
+
+@contextmanager
+def sync(prefix=TABLE_PREFIX):
+    """ Reads every table and column starting with the prefix (by default,
+        all dynamic tables) at once, and keeps this snapshot for any schema
+        checks made until the end of the block.
+        If the current sync already covers the prefix, it is reused.
+    """
+    previous = get_current_snapshot()
+    if previous is not None and previous.covers(prefix):
+        yield previous
+        return
+
+    _local.snapshot = SchemaSnapshot(prefix)
+    try:
+        yield _local.snapshot
+    finally:
+        _local.snapshot = previous
@@ -0,0 +1,432 @@
+# -*- coding: UTF-8 -*-
+""" Changes to response tables made in the background, instead of while the
+    question is being saved (when SURVEYMAKER_ONLINE_SCHEMA_CHANGES is set).
+
+    Saving a question only records a PendingSchemaChange. Until the change
+    has been made, the response model leaves out new questions and reads
+    renamed questions from their old column. The changes are made by
+    apply_pending_changes() (see the apply_schema_changes command), which
+    uses the backend's cheapest way of making each one:
+
+     * Nullable columns are added as they are, which never rewrites the table.
+     * Other columns are added as nullable, then given their default for
+       new rows (except TEXT and BLOB columns on MySQL, which can't have
+       one), then existing rows are filled in a batch at a time.
+       On SQLite, a column with a constant default is added directly.
+     * Columns are renamed in place where the backend can do so without
+       copying the table (PostgreSQL, SQLite 3.25+).
+     * On MySQL, the table is copied to a renamed shadow table a batch at a
+       time (with triggers copying any writes made meanwhile), and the two
+       are swapped.
+
+    Once a survey's changes have been made (or as soon as a column has been
+    renamed), its schema version is bumped and the change is announced, so
+    processes switch to the new model only once the table is ready for it.
+"""
+
+import copy
+import datetime
+import logging
+import sqlite3
+import threading
+
+from django.contrib import admin
+from django.db import connection, transaction
+from django.db.backends.util import truncate_name
+from django.db.models import get_model, Q
+from django.db.models.fields import NOT_PROVIDED
+from south.db import db
+
+from . import app_settings
+from . import schema
+from . import utils
+from .dynamic_models import get_field_name, get_response_table_name
+
+logger = logging.getLogger('surveymaker')
+
+PENDING = 'pending'
+RUNNING = 'running'
+FAILED = 'failed'
+
+# The change being made by this thread
+_local = threading.local()
+
+
+class ChangeReclaimed(Exception):
+    """ The change being made was reclaimed (see reclaim_stale_changes), so
+        another worker may now be making it.
+    """
+
+
+def get_pending_columns(survey):
+    """ Returns the column holding the answers of each question with changes
+        still to be made (by question id), or "" if it has no column yet.
+    """
+    PendingSchemaChange = get_model('surveymaker', 'PendingSchemaChange')
+    return dict(PendingSchemaChange.objects.filter(survey=survey)
+                    .values_list('question', 'old_column'))
+
+
+def get_all_pending_columns(surveys):
+    """ Bulk version of get_pending_columns, with one query for all of the
+        given surveys. Returns a dict of survey id to pending columns.
+    """
+    PendingSchemaChange = get_model('surveymaker', 'PendingSchemaChange')
+    pending = dict((survey.pk, {}) for survey in surveys)
+    for survey_id, question_id, old_column in PendingSchemaChange.objects.filter(
+            survey__in=pending.keys()).values_list('survey', 'question', 'old_column'):
+        pending[survey_id][question_id] = old_column
+    return pending
+
+
+def queue_change(question, old_slug=None):
+    """ Records the changes needed to the response table for the given
+        (possibly renamed) question. Returns False if no change is needed.
+    """
+    PendingSchemaChange = get_model('surveymaker', 'PendingSchemaChange')
+
+    # The column of an earlier pending change is still where the answers are
+    if PendingSchemaChange.objects.filter(question=question).exists():
+        return True
+
+    table_name = get_response_table_name(question.survey)
+    with schema.sync(table_name) as snapshot:
+        columns = snapshot.get_columns(table_name)
+    field_name = get_field_name(question)
+
+    if old_slug and old_slug in columns and old_slug != field_name:
+        old_column = old_slug
+    elif field_name not in columns:
+        old_column = ""
+    else:
+        return False
+
+    PendingSchemaChange.objects.create(survey=question.survey, question=question,
+                                       old_column=old_column)
+    logger.debug("Queued change to '%s' on %s" % (field_name, table_name))
+    return True
+
+
+def apply_pending_changes():
+    """ Makes every pending change, a survey at a time.
+        Returns the number of changes made.
+    """
+    PendingSchemaChange = get_model('surveymaker', 'PendingSchemaChange')
+    Survey = get_model('surveymaker', 'Survey')
+    survey_ids = set(PendingSchemaChange.objects.filter(status=PENDING)
+                        .values_list('survey', flat=True))
+    return sum(apply_survey_changes(survey) for survey in Survey.objects.filter(pk__in=survey_ids))
+
+
+def reclaim_stale_changes(seconds):
+    """ Returns changes whose worker hasn't reported progress for the given
+        number of seconds (eg. because it died) to the queue. Workers report
+        progress after each batch of a change (see _heartbeat), so seconds
+        should be longer than any one batch could take.
+        Returns the number of changes reclaimed.
+    """
+    PendingSchemaChange = get_model('surveymaker', 'PendingSchemaChange')
+    started_before = datetime.datetime.now() - datetime.timedelta(seconds=seconds)
+    stale = Q(started__lt=started_before) | Q(started__isnull=True)
+    return PendingSchemaChange.objects.filter(stale, status=RUNNING).update(status=PENDING, started=None)
+
+
+def apply_survey_changes(survey):
+    """ Makes the survey's pending changes, then announces its new model.
+        A renamed column is announced as soon as it has been renamed, as
+        processes still using the old model can't read or write the table
+        until they switch to the new one. Added columns are left out of the
+        old model, so are announced together at the end.
+        Changes that fail are marked as failed, and left for inspection.
+    """
+    PendingSchemaChange = get_model('surveymaker', 'PendingSchemaChange')
+    changes = PendingSchemaChange.objects.filter(survey=survey, status=PENDING)
+    applied = 0
+    unannounced = 0
+    for change in changes.select_related('question').order_by('pk'):
+        # Claim the change, in case another worker is also running
+        change.started = _now()
+        if not PendingSchemaChange.objects.filter(pk=change.pk, status=PENDING).update(
+                status=RUNNING, started=change.started):
+            continue
+        _local.change = change
+        try:
+            renamed = apply_change(change)
+        except ChangeReclaimed:
+            # Left to the worker that has it now
+            logger.warning("Change to '%s' on survey %s was reclaimed" % (change.question.slug, survey))
+            continue
+        except Exception as e:
+            logger.exception("Could not change '%s' on survey %s" % (change.question.slug, survey))
+            PendingSchemaChange.objects.filter(pk=change.pk).update(status=FAILED, error=unicode(e))
+            continue
+        finally:
+            _local.change = None
+
+        # Unless it was reclaimed after its last batch
+        PendingSchemaChange.objects.filter(pk=change.pk, started=change.started).delete()
+        applied += 1
+        unannounced += 1
+        if renamed:
+            announce_changes(survey)
+            unannounced = 0
+
+    if unannounced:
+        announce_changes(survey)
+    return applied
+
+
+def announce_changes(survey):
+    """ Bumps the survey's schema version and announces its new model, so
+        that processes switch to it. Only now can they use the changes made.
+    """
+    survey.bump_schema_version()
+    Response = survey.get_survey_response_model(regenerate=True, notify_changes=False)
+    if not app_settings.DYNAMIC_ADMIN:
+        utils.reregister_in_admin(admin.site, Response)
+    utils.notify_model_change(Response)
+
+
+def apply_change(change):
+    """ Adds or renames the column of the change's question.
+        Returns True if a column was renamed.
+    """
+    question = change.question
+    table_name = get_response_table_name(question.survey)
+    field_name = get_field_name(question)
+    field = question.get_field()
+    field.set_attributes_from_name(field_name)
+
+    with schema.sync(table_name) as snapshot:
+        columns = snapshot.get_columns(table_name)
+        if change.old_column in columns and change.old_column != field.column:
+            rename_column(table_name, change.old_column, field_name, field)
+            snapshot.rename_column(table_name, change.old_column, field.column)
+            return True
+        elif field.column not in columns:
+            add_column(table_name, field_name, field)
+            snapshot.add_column(table_name, field.column)
+        else:
+            # An earlier attempt (since reclaimed) added the column, but may
+            # not have filled it in
+            fill_column(table_name, field)
+    return False
+
+
+def add_column(table_name, field_name, field):
+    """ Adds a column for the field without rewriting (or locking) the table. """
+    qn = connection.ops.quote_name
+
+    if connection.vendor == 'sqlite':
+        # SQLite adds a column with a constant default without touching rows
+        _execute_ddl('ALTER TABLE %s ADD COLUMN %s' % (
+            qn(table_name), db.column_sql(table_name, field_name, field)))
+
+    elif field.null or not field.has_default():
+        db.start_transaction()
+        db.add_column(table_name, field_name, field, keep_default=False)
+        db.commit_transaction()
+
+    else:
+        # Add the column as nullable (without a default, which could rewrite
+        # the table), give new rows the default, then fill in existing rows.
+        # The column is left nullable, as enforcing NOT NULL would mean
+        # scanning (or on MySQL, rebuilding) the table. The model always gives
+        # a value anyway.
+        nullable = copy.copy(field)
+        nullable.null = True
+        nullable.default = NOT_PROVIDED
+        default = field.get_db_prep_save(field.get_default(), connection=connection)
+
+        db.start_transaction()
+        db.add_column(table_name, field_name, nullable, keep_default=False)
+        # MySQL can't give TEXT or BLOB columns a default, so rows added
+        # meanwhile are filled in along with the existing ones
+        if not _is_mysql_blob(field):
+            db.execute('ALTER TABLE %s ALTER COLUMN %s SET DEFAULT %%s' % (
+                qn(table_name), qn(field.column)), [default])
+        db.commit_transaction()
+
+        fill_column(table_name, field)
+
+    logger.debug("Added field '%s' to table '%s'" % (field_name, table_name))
+
+
+def fill_column(table_name, field):
+    """ Gives existing rows the field's default, a batch at a time, where a
+        column was added as nullable for a field that isn't (see add_column).
+    """
+    if connection.vendor == 'sqlite' or field.null or not field.has_default():
+        return
+    qn = connection.ops.quote_name
+    default = field.get_db_prep_save(field.get_default(), connection=connection)
+
+    # Rows added while filling (without the column's default, see
+    # add_column) are filled in too, until none are left
+    filled = 0
+    while True:
+        batches = list(_batches(table_name, start=filled))
+        if not batches:
+            break
+        for low, high in batches:
+            with transaction.commit_on_success():
+                connection.cursor().execute(
+                    'UPDATE %s SET %s = %%s WHERE %s > %%s AND %s <= %%s AND %s IS NULL' % (
+                        qn(table_name), qn(field.column), qn('id'), qn('id'), qn(field.column)),
+                    [default, low, high])
+            filled = high
+
+
+def _is_mysql_blob(field):
+    """ Returns True if the field's MySQL column type (eg. TEXT, for
+        LongText answers) can't have a default.
+    """
+    if connection.vendor != 'mysql':
+        return False
+    db_type = field.db_type(connection=connection).lower()
+    return 'text' in db_type or 'blob' in db_type
+
+
+def rename_column(table_name, old_column, field_name, field):
+    """ Renames a column without rewriting the table where possible. """
+    qn = connection.ops.quote_name
+
+    if connection.vendor == 'postgresql' or (
+            connection.vendor == 'sqlite' and sqlite3.sqlite_version_info >= (3, 25)):
+        _execute_ddl('ALTER TABLE %s RENAME COLUMN %s TO %s' % (
+            qn(table_name), qn(old_column), qn(field.column)))
+    elif connection.vendor == 'mysql':
+        copy_and_swap(table_name, old_column, field_name, field)
+    else:
+        db.start_transaction()
+        db.rename_column(table_name, old_column, field.column)
+        db.commit_transaction()
+
+    logger.debug("Renamed column '%s' to '%s' on %s" % (old_column, field.column, table_name))
+
+
+def copy_and_swap(table_name, old_column, field_name, field):
+    """ Renames a MySQL column by copying the table to a shadow table with
+        the renamed column, a batch at a time, and swapping the two.
+        While the table is copied, triggers copy any responses added,
+        changed or deleted to the shadow table, so nothing is lost in the
+        swap. (With binary logging on, creating triggers needs the SUPER
+        privilege or log_bin_trust_function_creators.)
+    """
+    qn = connection.ops.quote_name
+    shadow_name = _get_related_name(table_name, 'shadow')
+    retired_name = _get_related_name(table_name, 'retired')
+
+    # Anything left behind by an earlier attempt that didn't finish
+    _drop_shadow_table(table_name)
+    _execute_ddl('DROP TABLE IF EXISTS %s' % qn(retired_name))
+
+    _execute_ddl('CREATE TABLE %s LIKE %s' % (qn(shadow_name), qn(table_name)))
+    _execute_ddl('ALTER TABLE %s CHANGE %s %s' % (qn(shadow_name), qn(old_column),
+                    db.column_sql(shadow_name, field_name, field)))
+
+    cursor = connection.cursor()
+    cursor.execute('SHOW COLUMNS FROM %s' % qn(table_name))
+    old_columns = [row[0] for row in cursor.fetchall()]
+    new_columns = [field.column if c == old_column else c for c in old_columns]
+    target_columns = ', '.join(map(qn, new_columns))
+    new_values = ', '.join('NEW.%s' % qn(c) for c in old_columns)
+
+    # Writes to the table are repeated on the shadow table from now on
+    triggers = {
+        'insert': 'REPLACE INTO %s (%s) VALUES (%s)' % (qn(shadow_name), target_columns, new_values),
+        'update': 'REPLACE INTO %s (%s) VALUES (%s)' % (qn(shadow_name), target_columns, new_values),
+        'delete': 'DELETE FROM %s WHERE %s = OLD.%s' % (qn(shadow_name), qn('id'), qn('id')),
+        }
+    try:
+        for event, statement in sorted(triggers.items()):
+            _execute_ddl('CREATE TRIGGER %s AFTER %s ON %s FOR EACH ROW %s' % (
+                qn(_get_trigger_name(table_name, event)), event.upper(), qn(table_name), statement))
+
+        # Rows the triggers have already copied are newer, so are kept
+        for low, high in _batches(table_name):
+            with transaction.commit_on_success():
+                connection.cursor().execute(
+                    'INSERT IGNORE INTO %s (%s) SELECT %s FROM %s WHERE %s > %%s AND %s <= %%s' % (
+                        qn(shadow_name), target_columns, ', '.join(map(qn, old_columns)),
+                        qn(table_name), qn('id'), qn('id')),
+                    [low, high])
+    except ChangeReclaimed:
+        # The shadow table is the other worker's now
+        raise
+    except Exception:
+        _drop_shadow_table(table_name)
+        raise
+
+    # The swap only goes ahead if the change is still ours
+    _heartbeat()
+
+    # Swap atomically. Dropping the old table drops its triggers too.
+    _execute_ddl('RENAME TABLE %s TO %s, %s TO %s' % (qn(table_name), qn(retired_name),
+                    qn(shadow_name), qn(table_name)))
+    _execute_ddl('DROP TABLE %s' % qn(retired_name))
+
+
+def _drop_shadow_table(table_name):
+    """ Removes the shadow table of copy_and_swap(), and the triggers on the
+        original table that copy writes to it.
+    """
+    qn = connection.ops.quote_name
+    for event in ('delete', 'insert', 'update'):
+        _execute_ddl('DROP TRIGGER IF EXISTS %s' % qn(_get_trigger_name(table_name, event)))
+    _execute_ddl('DROP TABLE IF EXISTS %s' % qn(_get_related_name(table_name, 'shadow')))
+
+
+def _get_trigger_name(table_name, event):
+    return _get_related_name(table_name, 'shadow_%s' % event)
+
+
+def _get_related_name(table_name, suffix):
+    """ Names a table or trigger after the given table, shortened (with a
+        hash, as Django shortens names) to fit the backend's limit, eg. 64
+        characters on MySQL.
+    """
+    return truncate_name('%s_%s' % (table_name, suffix), connection.ops.max_name_length())
+
+
+def _batches(table_name, start=0):
+    """ Yields (low, high] ranges of ids covering the given table (above
+        start), each of up to SCHEMA_CHANGE_BATCH_SIZE ids.
+    """
+    qn = connection.ops.quote_name
+    cursor = connection.cursor()
+    cursor.execute('SELECT MAX(%s) FROM %s' % (qn('id'), qn(table_name)))
+    max_id = cursor.fetchone()[0] or 0
+    batch_size = app_settings.SCHEMA_CHANGE_BATCH_SIZE
+    for low in range(start, max_id, batch_size):
+        _heartbeat()
+        yield low, min(low + batch_size, max_id)
+
+
+def _heartbeat():
+    """ Records that the change this thread is making is still in progress,
+        so that it isn't reclaimed. Raises ChangeReclaimed if it already has
+        been, ie. if its start time isn't the one this worker last recorded.
+    """
+    change = getattr(_local, 'change', None)
+    if change is None:
+        return
+    now = _now()
+    if now == change.started:
+        return
+    PendingSchemaChange = get_model('surveymaker', 'PendingSchemaChange')
+    if not PendingSchemaChange.objects.filter(pk=change.pk, status=RUNNING,
+                                              started=change.started).update(started=now):
+        raise ChangeReclaimed("Change %s was reclaimed by another worker" % change.pk)
+    change.started = now
+
+
+def _now():
+    # Whole seconds, as some databases (eg. MySQL) don't keep microseconds
+    return datetime.datetime.now().replace(microsecond=0)
+
+
+def _execute_ddl(sql, params=None):
+    db.start_transaction()
+    db.execute(sql, params or [])
+    db.commit_transaction()
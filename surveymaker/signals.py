@@ -1,10 +1,30 @@
 #!/usr/bin/env python
 # -*- coding: UTF-8 -*-
 
+from contextlib import contextmanager
+import threading
+
 from django.contrib import admin
 from django.core.exceptions import ObjectDoesNotExist
+from django.db.models import F, get_model
+from django.dispatch import Signal
+from django.utils.datastructures import SortedDict
 
+from . import aggregates
+from . import app_settings
+from . import schema
+from . import schema_changes
+from . import summaries
 from . import utils
+from .dynamic_models import get_response_table_name, record_table_checked
+
+
+# Sent by ingest.insert_rows, with the response model as the sender, after
+# responses have been inserted without creating model instances.
+# fields is the list of fields that rows (lists of values) correspond to.
+responses_bulk_created = Signal(providing_args=['fields', 'rows'])
+
+_local = threading.local()
 
 
 def question_pre_save(sender, instance, **kwargs):
@@ -29,35 +49,37 @@ def question_post_save(sender, instance, created, **kwargs):
         If the question slug has been renamed, rename the database column.
     """
     try:
-        # Regenerate our response model, which may have changed
-        Response = instance.survey.get_survey_response_model(regenerate=True, notify_changes=False)
-
-        # If we previously identified a renamed slug, then rename the column
-        if hasattr(instance, '_old_slug'):
-            utils.rename_db_column(Response, instance._old_slug, instance.slug)
-            del instance._old_slug
-
-        # If necessary, add any new columns
-        utils.add_necessary_db_columns(Response)
-
-        # Reregister the Survey model in the admin
-        utils.reregister_in_admin(admin.site, Response)
-
-        # Tell other process to regenerate their models
-        utils.notify_model_change(Response)
-
+        survey = instance.survey
     except ObjectDoesNotExist:
         return
 
+    old_slug = getattr(instance, '_old_slug', None)
+    if old_slug is not None:
+        del instance._old_slug
+
+    changes = _get_batched_changes(survey)
+    if changes is not None:
+        changes['questions'].add(instance.pk)
+        # The column still has the name it had when the batch started
+        if old_slug is not None:
+            changes['renamed'].setdefault(instance.pk, old_slug)
+    else:
+        update_response_table(survey, [instance], old_slug and {instance.pk: old_slug})
+
 
 def question_post_delete(sender, instance, **kwargs):
     """ If you delete a question from a survey, update the model. 
     """
+    if _get_batched_changes(instance.survey) is not None:
+        return
+    instance.survey.bump_schema_version()
     Response = instance.survey.get_survey_response_model(regenerate=True, notify_changes=True)
 
 
 def survey_post_save(sender, instance, created, **kwargs):
     """ Ensure that a table exists for this logger. """
+    if _get_batched_changes(instance) is not None:
+        return
 
     # Force our response model to regenerate
     Response = instance.get_survey_response_model(regenerate=True, notify_changes=False)
@@ -66,12 +88,140 @@ def survey_post_save(sender, instance, created, **kwargs):
     utils.create_db_table(Response)
 
     # Reregister the model in the admin
-    utils.reregister_in_admin(admin.site, Response)
+    if not app_settings.DYNAMIC_ADMIN:
+        utils.reregister_in_admin(admin.site, Response)
 
     # Tell other process to regenerate their models
     utils.notify_model_change(Response)
 
 
+def update_response_table(survey, questions=(), renamed=None):
+    """ Adapts the survey's response table to the given (changed) questions,
+        renaming columns of renamed questions (renamed maps question id to
+        the old slug), then announces the new model.
+    """
+    renamed = renamed or {}
+
+    # Leave any changes to the table to the background worker. Until
+    # they're made, every process keeps using the old columns. A new
+    # survey's table is created straight away, as nothing can be using it.
+    if app_settings.ONLINE_SCHEMA_CHANGES:
+        table_name = get_response_table_name(survey)
+        with schema.sync(table_name) as snapshot:
+            queued = snapshot.has_table(table_name) and [q for q in questions
+                        if schema_changes.queue_change(q, renamed.get(q.pk))]
+        if queued:
+            Response = survey.get_survey_response_model(regenerate=True, notify_changes=False)
+            if not app_settings.DYNAMIC_ADMIN:
+                utils.reregister_in_admin(admin.site, Response)
+            return
+
+    # Regenerate our response model, which may have changed
+    Response = survey.get_survey_response_model(regenerate=True, notify_changes=False)
+
+    # The table is only introspected once, for all of the changes
+    with schema.sync(Response._meta.db_table) as snapshot:
+        columns = snapshot.get_columns(Response._meta.db_table)
+
+        # If we previously identified a renamed slug, then rename the column
+        for question in questions:
+            old_slug = renamed.get(question.pk)
+            if old_slug in columns and question.slug not in columns:
+                utils.rename_db_column(Response, old_slug, question.slug)
+
+        # If necessary, add any new columns
+        utils.add_necessary_db_columns(Response)
+        record_table_checked(survey, Response)
+
+    # The questions' answers may now be summarised differently
+    if app_settings.RESPONSE_SUMMARIES:
+        summaries.rebuild_summaries(Response, questions)
+
+    # Now that the table is ready, let other processes know that the
+    # response model has changed. Our model is already current.
+    survey.bump_schema_version()
+    Response._schema_version = survey.schema_version
+
+    # Reregister the Survey model in the admin
+    if not app_settings.DYNAMIC_ADMIN:
+        utils.reregister_in_admin(admin.site, Response)
+
+    # Tell other process to regenerate their models
+    utils.notify_model_change(Response)
+
+
+def start_schema_batch():
+    """ Defers the table changes and model regeneration of any surveys and
+        questions saved (or questions deleted) until the matching
+        end_schema_batch() call, when each survey is updated only once.
+        Summaries that need rebuilding after responses are changed or
+        deleted are also only rebuilt then.
+    """
+    if not getattr(_local, 'schema_batch_depth', 0):
+        _local.schema_changes = SortedDict()
+        _local.stale_summaries = {}
+    _local.schema_batch_depth = getattr(_local, 'schema_batch_depth', 0) + 1
+
+
+def end_schema_batch():
+    """ Updates the table and model of each survey changed since the
+        outermost start_schema_batch() call.
+    """
+    depth = getattr(_local, 'schema_batch_depth', 0)
+    if not depth:
+        return
+    _local.schema_batch_depth = depth - 1
+    if _local.schema_batch_depth:
+        return
+
+    batched_changes, _local.schema_changes = _local.schema_changes, None
+    stale_summaries, _local.stale_summaries = _local.stale_summaries, None
+    Survey = get_model('surveymaker', 'Survey')
+    Question = get_model('surveymaker', 'Question')
+    with utils.admin_batch():
+        # Surveys and questions are read again, in case they were deleted or
+        # their changes were rolled back
+        for survey in Survey.objects.filter(pk__in=batched_changes.keys()):
+            changes = batched_changes[survey.pk]
+            questions = Question.objects.filter(pk__in=changes['questions'])
+            update_response_table(survey, questions, changes['renamed'])
+
+        # Summaries that changed responses left without a minimum or maximum
+        for survey in Survey.objects.filter(pk__in=stale_summaries.keys()):
+            questions = Question.objects.filter(pk__in=stale_summaries[survey.pk])
+            summaries.rebuild_summaries(survey.Response, questions)
+
+
+def reset_schema_batch():
+    """ Ends any batch left open in this thread (eg. by a request whose
+        response middleware didn't run), making the changes it deferred.
+    """
+    if getattr(_local, 'schema_batch_depth', 0):
+        _local.schema_batch_depth = 1
+        end_schema_batch()
+
+
+@contextmanager
+def schema_batch():
+    """ However many surveys and questions are saved in this block, each
+        survey's table and model are only updated once, at the end.
+    """
+    start_schema_batch()
+    try:
+        yield
+    finally:
+        end_schema_batch()
+
+
+def _get_batched_changes(survey):
+    """ Returns the changes to the given survey that are waiting for the end
+        of the current batch, or None if there is no batch.
+    """
+    if not getattr(_local, 'schema_batch_depth', 0):
+        return None
+    return _local.schema_changes.setdefault(survey.pk, {'questions': set(), 'renamed': {}})
+
+
 def survey_pre_delete(sender, instance, **kwargs):
     Response = instance.Response
 
@@ -79,6 +229,76 @@ def survey_pre_delete(sender, instance, **kwargs):
     #utils.delete_db_table(Response)
 
     # unregister from the admin site
-    utils.unregister_from_admin(admin.site, Response)
+    if not app_settings.DYNAMIC_ADMIN:
+        utils.unregister_from_admin(admin.site, Response)
+
+
 
 
+def response_pre_save(sender, instance, **kwargs):
+    """ Reads a changed response's previous answers, so they can be taken
+        out of its survey's summaries.
+    """
+    if (sender._meta.app_label == 'responses' and app_settings.RESPONSE_SUMMARIES
+            and instance.pk is not None):
+        instance._old_summary_values = summaries.read_response_values(sender, instance.pk)
+
+
+def response_post_save(sender, instance, created, **kwargs):
+    """ Keep count of the responses to each survey, and their summaries. """
+    if sender._meta.app_label != 'responses':
+        return
+    if created:
+        _add_to_response_count(sender, 1)
+    _invalidate_aggregates(sender)
+    if app_settings.RESPONSE_SUMMARIES:
+        summaries.add_response(instance)
+        old_values = getattr(instance, '_old_summary_values', None)
+        if old_values is not None:
+            del instance._old_summary_values
+            stale = summaries.remove_responses(sender, summaries.get_summary_fields(sender), [old_values])
+            _rebuild_summaries(sender, stale)
+
+
+def response_post_delete(sender, instance, **kwargs):
+    if sender._meta.app_label == 'responses':
+        _add_to_response_count(sender, -1)
+        _invalidate_aggregates(sender)
+        if app_settings.RESPONSE_SUMMARIES:
+            _rebuild_summaries(sender, summaries.remove_response(instance))
+
+
+def _rebuild_summaries(Response, question_ids):
+    """ Rebuilds the summaries of the given questions now, or if there is a
+        batch (see start_schema_batch), once at the end of the batch.
+    """
+    if not question_ids:
+        return
+    if getattr(_local, 'schema_batch_depth', 0):
+        _local.stale_summaries.setdefault(Response._survey_id, set()).update(question_ids)
+        return
+    Question = get_model('surveymaker', 'Question')
+    summaries.rebuild_summaries(Response, Question.objects.filter(pk__in=question_ids))
+
+
+def responses_bulk_saved(sender, fields, rows, **kwargs):
+    _add_to_response_count(sender, len(rows))
+    _invalidate_aggregates(sender)
+    if app_settings.RESPONSE_SUMMARIES:
+        summaries.add_responses(sender, fields, rows)
+
+
+def _invalidate_aggregates(Response):
+    """ Stops the survey's cached aggregates being used (only needed when
+        they are calculated by aggregates.py, instead of from summaries).
+    """
+    if not app_settings.RESPONSE_SUMMARIES:
+        aggregates.invalidate_aggregates(Response._survey_id)
+
+
+def _add_to_response_count(Response, count):
+    """ Adds to the survey's response count, in the transaction that saved
+        (see dynamic_models.save_response) or deleted the responses.
+    """
+    Survey = get_model('surveymaker', 'Survey')
+    Survey.objects.filter(pk=Response._survey_id).update(response_count=F('response_count') + count)
@@ -0,0 +1,208 @@
+# -*- coding: UTF-8 -*-
+""" Running totals of each survey's answers, kept in ResponseSummary rows
+    when SURVEYMAKER_RESPONSE_SUMMARIES is set.
+    New responses are added to the totals as they are saved (and changed or
+    deleted responses taken out), so reading a survey's summary only needs a
+    row per question (or choice), however many responses there are.
+"""
+
+from decimal import Decimal
+
+from django.db import IntegrityError, transaction
+from django.db.models import F, Q, get_model
+from django.db.models.fields import FieldDoesNotExist
+from django.utils.datastructures import SortedDict
+
+from .aggregates import NUMERIC_TYPES, calculate_aggregates, to_number
+from .dynamic_models import get_field_name
+
+
+def add_response(response):
+    """ Adds a newly saved response to the survey's summaries. """
+    Response = type(response)
+    fields = get_summary_fields(Response)
+    add_responses(Response, fields, [[getattr(response, f.attname) for f in fields]])
+
+
+def add_responses(Response, fields, rows):
+    """ Adds the given responses (lists of values, corresponding to fields)
+        to the survey's summaries.
+    """
+    for (question_id, choice), (count, total, minimum, maximum) in _get_totals(Response, fields, rows).items():
+        _merge(question_id, choice, count, total, minimum, maximum)
+
+
+def remove_response(response):
+    """ Takes a deleted response out of the survey's summaries. Returns the
+        ids of the questions whose summaries need to be rebuilt, see
+        remove_responses().
+    """
+    Response = type(response)
+    fields = get_summary_fields(Response)
+    return remove_responses(Response, fields, [[getattr(response, f.attname) for f in fields]])
+
+
+def remove_responses(Response, fields, rows):
+    """ Takes the given (previously added) responses out of the survey's
+        summaries. The minimum or maximum of a question can't be worked out
+        again without reading every response, so the ids of questions
+        whose minimum or maximum answer was removed are returned, for their
+        summaries to be rebuilt.
+    """
+    ResponseSummary = get_model('surveymaker', 'ResponseSummary')
+    stale = set()
+    for (question_id, choice), (count, total, minimum, maximum) in _get_totals(Response, fields, rows).items():
+        summaries = ResponseSummary.objects.filter(question=question_id, choice=choice)
+        changes = {'count': F('count') - count}
+        if total is not None:
+            changes['total'] = F('total') - total
+        summaries.update(**changes)
+        if minimum is not None and summaries.filter(Q(minimum__gte=minimum) | Q(maximum__lte=maximum)).exists():
+            stale.add(question_id)
+    return stale
+
+
+def read_response_values(Response, pk):
+    """ Returns the values of the fields of get_summary_fields() saved for
+        the given response, or None if it hasn't been saved.
+    """
+    fields = get_summary_fields(Response)
+    rows = list(Response.objects.filter(pk=pk).values_list(*[f.attname for f in fields]))
+    return rows and list(rows[0]) or None
+
+
+def get_summary_fields(Response):
+    """ The fields of the response model that have summaries. """
+    return [f for f in Response._meta.local_fields if f.name in Response._question_ids]
+
+
+def _get_totals(Response, fields, rows):
+    """ Returns the count, total, minimum and maximum of the given responses
+        (lists of values, corresponding to fields) by question id and choice.
+    """
+    totals = {}
+    for index, field in enumerate(fields):
+        question_id = Response._question_ids.get(field.name)
+        if question_id is None:
+            continue
+
+        if field.choices:
+            choice_keys = dict((value, unicode(value)) for value, label in field.choices)
+            for row in rows:
+                choice = choice_keys.get(_to_python(field, row[index]))
+                if choice is not None:
+                    totals.setdefault((question_id, choice), [0, None, None, None])[0] += 1
+
+        elif _is_numeric(field):
+            for row in rows:
+                value = _to_python(field, row[index])
+                if value is None:
+                    continue
+                total = totals.setdefault((question_id, ''), [0, 0, value, value])
+                total[0] += 1
+                total[1] += value
+                total[2] = min(total[2], value)
+                total[3] = max(total[3], value)
+    return totals
+
+
+def _merge(question_id, choice, count, total, minimum, maximum):
+    """ Adds the given totals to a summary row, creating it if necessary. """
+    ResponseSummary = get_model('surveymaker', 'ResponseSummary')
+    summaries = ResponseSummary.objects.filter(question=question_id, choice=choice)
+
+    changes = {'count': F('count') + count}
+    if total is not None:
+        changes['total'] = F('total') + total
+    if not summaries.update(**changes):
+        try:
+            sid = transaction.savepoint()
+            ResponseSummary.objects.create(question_id=question_id, choice=choice,
+                count=count, total=total, minimum=minimum, maximum=maximum)
+            transaction.savepoint_commit(sid)
+            return
+        except IntegrityError:
+            # Another process created it first
+            transaction.savepoint_rollback(sid)
+            summaries.update(**changes)
+
+    if minimum is not None:
+        summaries.filter(Q(minimum__gt=minimum) | Q(minimum__isnull=True)).update(minimum=minimum)
+    if maximum is not None:
+        summaries.filter(Q(maximum__lt=maximum) | Q(maximum__isnull=True)).update(maximum=maximum)
+
+
+def rebuild_summaries(Response, questions):
+    """ Recalculates the summaries of the given questions from the responses,
+        eg. after a question or existing responses have changed.
+    """
+    ResponseSummary = get_model('surveymaker', 'ResponseSummary')
+    questions = list(questions)
+    aggregates = calculate_aggregates(Response, questions)['questions']
+
+    ResponseSummary.objects.filter(question__in=questions).delete()
+    for question in questions:
+        aggregate = aggregates.get(question.slug)
+        if aggregate is None:
+            continue
+        if 'choices' in aggregate:
+            for value, label, count in aggregate['choices']:
+                ResponseSummary.objects.create(question=question, choice=unicode(value), count=count)
+        else:
+            ResponseSummary.objects.create(question=question, count=aggregate['count'],
+                total=aggregate['sum'], minimum=aggregate['min'], maximum=aggregate['max'])
+
+
+def rebuild_survey_summaries(Response):
+    """ Recalculates all of a survey's summaries, eg. after responses have
+        been changed without saving them through the model.
+    """
+    Question = get_model('surveymaker', 'Question')
+    rebuild_summaries(Response, Question.objects.filter(survey=Response._survey_id))
+
+
+def get_summaries(survey):
+    """ Returns the survey's summaries, in the same form as
+        aggregates.get_response_aggregates.
+    """
+    ResponseSummary = get_model('surveymaker', 'ResponseSummary')
+    Response = survey.Response
+    summaries = {}
+    for summary in ResponseSummary.objects.filter(question__survey=survey):
+        summaries[(summary.question_id, summary.choice)] = summary
+
+    questions = SortedDict()
+    for question in survey.question_set.all():
+        try:
+            field = Response._meta.get_field(get_field_name(question))
+        except FieldDoesNotExist:
+            continue
+
+        if field.choices:
+            questions[question.slug] = {'choices': [(value, label,
+                getattr(summaries.get((question.pk, unicode(value))), 'count', 0))
+                for value, label in field.choices]}
+
+        elif question.answer_type in NUMERIC_TYPES:
+            summary = summaries.get((question.pk, ''))
+            count = summary and summary.count or 0
+            total = summary and summary.total or 0
+            questions[question.slug] = {
+                'count': count,
+                'sum': to_number(field, total),
+                'min': summary and to_number(field, summary.minimum),
+                'max': summary and to_number(field, summary.maximum),
+                'mean': Decimal(total) / count if count else None,
+                }
+
+    return {'responses': survey.response_count, 'questions': questions}
+
+
+def _is_numeric(field):
+    return field.get_internal_type() in ('IntegerField', 'DecimalField')
+
+
+def _to_python(field, value):
+    if value in (None, ''):
+        return None
+    return field.to_python(value)
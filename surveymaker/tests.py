@@ -0,0 +1,273 @@
+# -*- coding: UTF-8 -*-
+""" Tests for the surveymaker app. Response tables are created and altered
+    (which SQLite commits straight away), and aren't emptied between tests
+    (as the responses app isn't installed), so each test uses its own survey.
+"""
+
+from django.core.exceptions import ValidationError
+from django.test import TransactionTestCase
+
+from . import aggregates
+from . import app_settings
+from . import ingest
+from . import schema_changes
+from . import summaries
+from .models import Survey, Question, PendingSchemaChange, ResponseSummary
+
+
+class SettingsMixin(object):
+    """ Sets the given app settings for each test, as they are read when
+        the app is loaded.
+    """
+    app_settings = {}
+
+    def setUp(self):
+        self._old_settings = dict((name, getattr(app_settings, name)) for name in self.app_settings)
+        for name, value in self.app_settings.items():
+            setattr(app_settings, name, value)
+
+    def tearDown(self):
+        for name, value in self._old_settings.items():
+            setattr(app_settings, name, value)
+
+
+def get_test_slug(test):
+    """ Returns a survey slug for the given test only. """
+    return filter(str.isalpha, '%s%s' % (type(test).__name__, test._testMethodName)).lower()
+
+
+def create_survey(slug, *questions):
+    """ Creates a survey with the given questions, as (slug, answer type) or
+        (slug, answer type, choices).
+    """
+    survey = Survey.objects.create(name=slug.title(), slug=slug)
+    for question in questions:
+        create_question(survey, *question)
+    return Survey.objects.get(pk=survey.pk)
+
+
+def create_question(survey, slug, answer_type, choices=""):
+    return Question.objects.create(survey=survey, question=slug.title(), slug=slug,
+                                   answer_type=answer_type, choices=choices)
+
+
+class SchemaChangesTest(SettingsMixin, TransactionTestCase):
+    app_settings = {'ONLINE_SCHEMA_CHANGES': True}
+
+    def test_add_column(self):
+        survey = create_survey('onlineadd')
+        create_question(survey, 'name', 'ShortText')
+        survey = Survey.objects.get(pk=survey.pk)
+        self.assertEqual(list(PendingSchemaChange.objects.values_list('old_column', 'status')),
+                         [(u'', schema_changes.PENDING)])
+
+        # The question is left out until its column has been added
+        Response = survey.Response
+        self.assertEqual(Response._data_fields, ())
+        for i in range(3):
+            Response.objects.create()
+
+        version = survey.schema_version
+        self.assertEqual(schema_changes.apply_survey_changes(survey), 1)
+        self.assertFalse(PendingSchemaChange.objects.exists())
+
+        survey = Survey.objects.get(pk=survey.pk)
+        self.assertEqual(survey.schema_version, version + 1)
+        Response = survey.Response
+        self.assertEqual(Response._data_fields, ('name',))
+        # Existing rows have the question's default
+        self.assertEqual(list(Response.objects.values_list('name', flat=True)), [u''] * 3)
+        Response.objects.create(name=u'new')
+        self.assertEqual(Response.objects.filter(name=u'new').count(), 1)
+
+    def test_rename_column(self):
+        survey = create_survey('onlinerename')
+        question = create_question(survey, 'name', 'ShortText')
+        schema_changes.apply_survey_changes(survey)
+        survey = Survey.objects.get(pk=survey.pk)
+        survey.Response.objects.create(name=u'before')
+
+        question.slug = 'fullname'
+        question.save()
+        survey = Survey.objects.get(pk=survey.pk)
+        self.assertEqual(list(PendingSchemaChange.objects.values_list('old_column', flat=True)),
+                         [u'name'])
+
+        # Until the column is renamed, the answers are read from the old one
+        Response = survey.Response
+        self.assertEqual(Response._meta.get_field('fullname').column, 'name')
+        Response.objects.create(fullname=u'during')
+
+        self.assertEqual(schema_changes.apply_survey_changes(survey), 1)
+        survey = Survey.objects.get(pk=survey.pk)
+        Response = survey.Response
+        self.assertEqual(Response._meta.get_field('fullname').column, 'fullname')
+        self.assertEqual(list(Response.objects.order_by('pk').values_list('fullname', flat=True)),
+                         [u'before', u'during'])
+
+    def test_announce_each_rename(self):
+        survey = create_survey('onlineannounce', ('name', 'ShortText'))
+        schema_changes.apply_survey_changes(survey)
+        question = Question.objects.get(survey=survey, slug='name')
+        question.slug = 'fullname'
+        question.save()
+        create_question(survey, 'colour', 'ShortText')
+        survey = Survey.objects.get(pk=survey.pk)
+
+        # Once for the rename, then once for the added column
+        version = survey.schema_version
+        self.assertEqual(schema_changes.apply_survey_changes(survey), 2)
+        survey = Survey.objects.get(pk=survey.pk)
+        self.assertEqual(survey.schema_version, version + 2)
+        self.assertEqual(sorted(survey.Response._data_fields), ['colour', 'fullname'])
+
+    def test_failed_change(self):
+        survey = create_survey('onlinefailed')
+        Question.objects.create(survey=survey, question='Broken', slug='broken',
+                                answer_type='Unknown')
+        survey = Survey.objects.get(pk=survey.pk)
+
+        version = survey.schema_version
+        self.assertEqual(schema_changes.apply_survey_changes(survey), 0)
+        change = PendingSchemaChange.objects.get()
+        self.assertEqual(change.status, schema_changes.FAILED)
+        self.assertTrue(change.error)
+        self.assertEqual(Survey.objects.get(pk=survey.pk).schema_version, version)
+
+    def test_claimed_change_is_skipped(self):
+        survey = create_survey('onlineclaimed')
+        create_question(survey, 'name', 'ShortText')
+        PendingSchemaChange.objects.update(status=schema_changes.RUNNING)
+        self.assertEqual(schema_changes.apply_survey_changes(Survey.objects.get(pk=survey.pk)), 0)
+        self.assertEqual(PendingSchemaChange.objects.get().status, schema_changes.RUNNING)
+
+
+class IngestTest(TransactionTestCase):
+
+    def setUp(self):
+        self.survey = create_survey(get_test_slug(self), ('age', 'Integer'), ('name', 'ShortText'),
+                                    ('colour', 'ShortText', 'red,blue'))
+        self.Response = self.survey.Response
+        self.fields = ingest.get_insert_fields(self.Response)
+
+    def clean_row(self, row):
+        values = ingest.clean_row(self.fields, row, ignored=('id',))
+        return dict(zip([f.name for f in self.fields], values))
+
+    def assertRowErrors(self, row, names):
+        try:
+            ingest.clean_row(self.fields, row, ignored=('id',))
+        except ValidationError as e:
+            self.assertEqual(sorted(e.message_dict), sorted(names))
+        else:
+            self.fail("%r was not rejected" % row)
+
+    def test_clean_row(self):
+        self.assertEqual(self.clean_row({'age': '5', 'name': u'Ann', 'colour': 'red'}),
+                         {'age': 5, 'name': u'Ann', 'colour': u'red'})
+        # Missing answers have the question's default
+        self.assertEqual(self.clean_row({'age': ''}), {'age': None, 'name': u'', 'colour': u''})
+        # Exported responses have an id, which is left out
+        self.assertEqual(self.clean_row({'id': '3', 'age': '1'})['age'], 1)
+
+    def test_clean_row_errors(self):
+        self.assertRowErrors({'age': 'many'}, ['age'])
+        self.assertRowErrors({'colour': 'green'}, ['colour'])
+        self.assertRowErrors({'age': '5', 'shoe': '9'}, ['shoe'])
+        self.assertRowErrors({}, ['__all__'])
+        self.assertRowErrors({'id': '3', 'shoe': '9'}, ['__all__', 'shoe'])
+
+    def test_insert_rows(self):
+        inserted = []
+        rows = [[1, u'a', u'red'], [2, u'b', u'']]
+        ingest.insert_rows(self.Response, self.fields, rows, lambda: inserted.append(True))
+
+        self.assertEqual(inserted, [True])
+        self.assertEqual(list(self.Response.objects.order_by('pk').values_list('age', 'name', 'colour')),
+                         [(1, u'a', u'red'), (2, u'b', u'')])
+        self.assertEqual(Survey.objects.get(pk=self.survey.pk).response_count, 2)
+
+        # Nothing to insert
+        ingest.insert_rows(self.Response, self.fields, [])
+        self.assertEqual(self.Response.objects.count(), 2)
+
+    def test_bulk_create_responses(self):
+        rows = [{'age': '1'}, None, {'age': 'x'}, [], {'name': u'b'}, {'age': '3'}]
+        created, errors = ingest.bulk_create_responses(self.Response, rows, chunk_size=2)
+        self.assertEqual(created, 3)
+        self.assertEqual([n for n, e in errors], [2, 3, 4])
+        self.assertEqual(self.Response.objects.count(), 3)
+
+
+class SummariesTest(SettingsMixin, TransactionTestCase):
+    app_settings = {'RESPONSE_SUMMARIES': True}
+
+    def setUp(self):
+        super(SummariesTest, self).setUp()
+        self.survey = create_survey(get_test_slug(self), ('score', 'Integer'),
+                                    ('colour', 'ShortText', 'red,blue'))
+        self.Response = self.survey.Response
+        self.score = Question.objects.get(survey=self.survey, slug='score')
+        self.colour = Question.objects.get(survey=self.survey, slug='colour')
+
+    def get_summary(self, question, choice=''):
+        summary = ResponseSummary.objects.get(question=question, choice=choice)
+        return summary.count, summary.total, summary.minimum, summary.maximum
+
+    def assertMatchesAggregates(self):
+        survey = Survey.objects.get(pk=self.survey.pk)
+        calculated = aggregates.calculate_aggregates(self.Response, survey.question_set.all())
+        self.assertEqual(summaries.get_summaries(survey)['questions'], calculated['questions'])
+
+    def test_add_responses(self):
+        self.Response.objects.create(score=3, colour='red')
+        self.Response.objects.create(score=7, colour='red')
+        self.assertEqual(self.get_summary(self.score), (2, 10, 3, 7))
+        self.assertEqual(self.get_summary(self.colour, 'red')[0], 2)
+
+        # Merged into the existing summaries
+        fields = summaries.get_summary_fields(self.Response)
+        rows = [[dict(score=1, colour=u'blue')[f.name] for f in fields],
+                [dict(score=9, colour=u'')[f.name] for f in fields]]
+        summaries.add_responses(self.Response, fields, rows)
+        self.assertEqual(self.get_summary(self.score), (4, 20, 1, 9))
+        self.assertEqual(self.get_summary(self.colour, 'red')[0], 2)
+        self.assertEqual(self.get_summary(self.colour, 'blue')[0], 1)
+        self.assertFalse(ResponseSummary.objects.filter(question=self.colour, choice='').exists())
+
+    def test_remove_response(self):
+        low = self.Response.objects.create(score=3, colour='red')
+        middle = self.Response.objects.create(score=5, colour='blue')
+        self.Response.objects.create(score=7, colour='red')
+
+        # Taken out of the totals, without needing a rebuild
+        self.assertEqual(summaries.remove_response(middle), set())
+        self.assertEqual(self.get_summary(self.score), (2, 10, 3, 7))
+        self.assertEqual(self.get_summary(self.colour, 'blue')[0], 0)
+
+        # The minimum can only be found again from the responses
+        self.assertEqual(summaries.remove_response(low), set([self.score.pk]))
+        self.assertEqual(self.get_summary(self.score)[:2], (1, 7))
+
+    def test_remove_responses(self):
+        for score in (2, 4, 6, 8):
+            self.Response.objects.create(score=score, colour='red')
+        fields = summaries.get_summary_fields(self.Response)
+        rows = [[dict(score=score, colour=u'red')[f.name] for f in fields] for score in (4, 6)]
+        self.assertEqual(summaries.remove_responses(self.Response, fields, rows), set())
+        self.assertEqual(self.get_summary(self.score), (2, 10, 2, 8))
+        self.assertEqual(self.get_summary(self.colour, 'red')[0], 2)
+
+    def test_changes_are_summarised(self):
+        responses = [self.Response.objects.create(score=score, colour=colour)
+                        for score, colour in ((1, 'red'), (5, 'blue'), (9, ''), (None, 'red'))]
+        self.assertMatchesAggregates()
+
+        responses[0].score = 4
+        responses[0].colour = 'blue'
+        responses[0].save()
+        self.assertMatchesAggregates()
+
+        responses[2].delete()
+        self.assertMatchesAggregates()
+        self.assertEqual(self.get_summary(self.score), (2, 9, 4, 5))
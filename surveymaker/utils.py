@@ -7,20 +7,56 @@ from django.contrib.admin.sites import NotRegistered
 from django.db.models.signals import class_prepared
 from django.db.models.loading import cache as app_cache
 
+from django.core.signals import request_started
 from django.core.urlresolvers import clear_url_caches
 from django.utils.importlib import import_module
 from django.core.cache import cache
 from django.conf import settings
 
+from contextlib import contextmanager
 import logging
+import threading
+import time
 from south.db import db
 
+from . import app_settings
+from . import instrumentation
+from . import invalidation
+from . import schema
+from .registry import lru, registry
+
 logger = logging.getLogger('surveymaker')
 
+# Per-thread state, eg. for deferring URL conf reloads
+_local = threading.local()
+
+# The lock held while each dynamic model is generated, by app label and name
+_model_locks = {}
+_model_locks_lock = threading.Lock()
+
 
 def unregister_from_admin(admin_site, model):
     " Removes the dynamic model from the given admin site "
 
+    _remove_from_admin_registry(admin_site, model)
+    reload_urlconf()
+
+
+@instrumentation.timed('admin.reregister', lambda admin_site, model, *args, **kwargs: instrumentation.model_tags(model))
+def reregister_in_admin(admin_site, model, admin_class=None):
+    " (re)registers a dynamic model in the given admin site "
+
+    # We use our own unregister, to ensure that the correct
+    # existing model is found 
+    # (Django's unregister doesn't expect the model class to change)
+    # The URL conf is only reloaded once the new model is registered, as
+    # reloading it can import admin modules that register the model.
+    _remove_from_admin_registry(admin_site, model)
+    admin_site.register(model, admin_class)
+    reload_urlconf()
+
+
+def _remove_from_admin_registry(admin_site, model):
     # First deregister the current definition
     # This is done "manually" because model will be different
     # db_table is used to check for class equivalence.
@@ -34,25 +70,59 @@ def unregister_from_admin(admin_site, model):
     except NotRegistered:
         pass
 
+
+def reload_urlconf():
+    """ Reloads the URL conf so that admin changes take effect, unless this
+        is being deferred until the end of a batch of admin changes.
+    """
+    if getattr(_local, 'admin_batch_depth', 0):
+        _local.urlconf_stale = True
+        return
+
     # Reload the URL conf and clear the URL cache
     # It's important to use the same string as ROOT_URLCONF
-    reload(import_module(settings.ROOT_URLCONF))
-    clear_url_caches()
+    with instrumentation.timer('admin.reload_urlconf'):
+        reload(import_module(settings.ROOT_URLCONF))
+        clear_url_caches()
 
 
-def reregister_in_admin(admin_site, model, admin_class=None):
-    " (re)registers a dynamic model in the given admin site "
+def start_admin_batch():
+    """ Defers URL conf reloads until the matching end_admin_batch() call. """
+    _local.admin_batch_depth = getattr(_local, 'admin_batch_depth', 0) + 1
 
-    # We use our own unregister, to ensure that the correct
-    # existing model is found 
-    # (Django's unregister doesn't expect the model class to change)
-    unregister_from_admin(admin_site, model)
-    admin_site.register(model, admin_class)
 
-    # Reload the URL conf and clear the URL cache
-    # It's important to use the same string as ROOT_URLCONF
-    reload(import_module(settings.ROOT_URLCONF))
-    clear_url_caches()
+def end_admin_batch():
+    """ Reloads the URL conf once, if any admin changes were made since the
+        outermost start_admin_batch() call.
+    """
+    depth = getattr(_local, 'admin_batch_depth', 0)
+    if not depth:
+        return
+    _local.admin_batch_depth = depth - 1
+    if not _local.admin_batch_depth and getattr(_local, 'urlconf_stale', False):
+        _local.urlconf_stale = False
+        reload_urlconf()
+
+
+def reset_admin_batch():
+    """ Ends any batch left open in this thread (eg. by a request whose
+        response middleware didn't run), reloading the URL conf if needed.
+    """
+    if getattr(_local, 'admin_batch_depth', 0):
+        _local.admin_batch_depth = 1
+        end_admin_batch()
+
+
+@contextmanager
+def admin_batch():
+    """ Any number of admin (re)registrations made in this block will only
+        reload the URL conf once, at the end.
+    """
+    start_admin_batch()
+    try:
+        yield
+    finally:
+        end_admin_batch()
 
 
 def when_classes_prepared(app_name, dependencies, fn):
@@ -110,35 +180,144 @@ def when_classes_prepared(app_name, dependencies, fn):
     class_prepared.connect(_class_prepared_handler, weak=False)
 
 
-def get_cached_model(app_label, model_name, regenerate=False, get_local_hash=lambda i: i._hash):
+def get_cached_model(app_label, model_name, version, regenerate=False):
+    """ Returns the previously generated model, if it is still current, ie.
+        its _schema_version is the given version (eg. the survey's, as
+        stored in the database).
+    """
 
     # If this model has already been generated, we'll find it here
     previous_model = models.get_model(app_label, model_name)
+    outcome = regenerate and 'regenerate' or 'hit'
 
-    # Before returning our locally cached model, check that it is still current
+    # Before returning our locally cached model, check that it is still current.
     if previous_model is not None and not regenerate:
-        CACHE_KEY = utils.HASH_CACHE_TEMPLATE % (app_label, model_name)
-        if cache.get(CACHE_KEY) != get_local_hash(previous_model):
-            logging.debug("Local and shared dynamic model hashes are different: %s (local) %s (shared)" % (get_local_hash(previous_model), cache.get(CACHE_KEY)))
+        local_version = previous_model._schema_version
+        if local_version != version:
+            logger.debug("Local and current dynamic model versions are different: %s (local) %s (current)" % (local_version, version))
             regenerate = True
+            outcome = 'stale'
 
-    # We can force regeneration by disregarding the previous model
+    # We can force regeneration by disregarding the previous model. It is
+    # left in Django's model cache, for the caller to remove (while holding
+    # the model's lock) just before generating the new one.
     if regenerate:
         previous_model = None
-        # Django keeps a cache of registered models, we need to make room for
-        # our new one
-        utils.remove_from_model_cache(app_label, model_name)
+
+    if previous_model is None:
+        lru.miss(app_label, model_name)
+        if outcome == 'hit':
+            outcome = 'miss'
+    else:
+        lru.hit(app_label, model_name)
+    instrumentation.incr_for_model('model_cache.' + outcome, model_name)
 
     return previous_model
 
 
+def get_registered_model(survey_id, version):
+    """ Returns the survey's response model from this process's registry, if
+        it was generated for the given schema version, otherwise None.
+    """
+    model = registry.get(survey_id, version)
+    if model is not None:
+        lru.hit(model._meta.app_label, model._meta.object_name)
+        instrumentation.incr_for_model('model_cache.hit', model)
+    return model
+
+
+def get_model_lock(app_label, model_name):
+    """ Returns the lock to hold while generating the given model, so that
+        threads needing the same model at the same time only generate it once.
+    """
+    key = (app_label, model_name)
+    lock = _model_locks.get(key)
+    if lock is None:
+        with _model_locks_lock:
+            lock = _model_locks.setdefault(key, threading.RLock())
+    return lock
+
+
+def acquire_schema_lease(model):
+    """ Decides whether this process should check the given model's table,
+        so that processes generating the same model at the same time don't
+        all introspect (and alter) the table.
+        Returns True if this process now holds the lease and should check the
+        table, then call release_schema_lease(). Returns False if another
+        process has checked this version of the model (waiting up to
+        SCHEMA_LEASE_WAIT seconds for a check in progress), or None if it
+        is still checking it.
+    """
+    app_label, model_name = model._meta.app_label, model._meta.object_name
+    checked_key = SCHEMA_CHECKED_CACHE_TEMPLATE % (app_label, model_name)
+    lease_key = SCHEMA_LEASE_CACHE_TEMPLATE % (app_label, model_name)
+
+    instrumentation.incr('shared_cache.get')
+    if cache.get(checked_key) == model._hash:
+        instrumentation.incr_for_model('schema_lease.checked', model)
+        return False
+    instrumentation.incr('shared_cache.set')
+    if cache.add(lease_key, model._hash, app_settings.SCHEMA_LEASE_TIMEOUT):
+        instrumentation.incr_for_model('schema_lease.acquired', model)
+        return True
+
+    deadline = time.time() + app_settings.SCHEMA_LEASE_WAIT
+    while time.time() < deadline:
+        time.sleep(0.05)
+        instrumentation.incr('shared_cache.get')
+        if cache.get(checked_key) == model._hash:
+            instrumentation.incr_for_model('schema_lease.waited', model)
+            return False
+    logger.debug("Gave up waiting for another process to check %s.%s" % (app_label, model_name))
+    instrumentation.incr_for_model('schema_lease.timeout', model)
+    return None
+
+
+def release_schema_lease(model, checked=True):
+    """ Gives up the lease taken with acquire_schema_lease(), recording that
+        the given model's table has been checked (unless the check failed).
+    """
+    app_label, model_name = model._meta.app_label, model._meta.object_name
+    if checked:
+        cache.set(SCHEMA_CHECKED_CACHE_TEMPLATE % (app_label, model_name), model._hash)
+        instrumentation.incr('shared_cache.set')
+    cache.delete(SCHEMA_LEASE_CACHE_TEMPLATE % (app_label, model_name))
+    instrumentation.incr('shared_cache.set')
+
+
 def remove_from_model_cache(app_label, model_name):
-    """ Removes the given model from the model cache. """
+    """ Removes the given model from the model cache (and from the models
+        counted towards MODEL_CACHE_SIZE).
+    """
+    lru.discard(app_label, model_name)
     try:
-        del app_cache.app_models[app_label][model_name.lower()]
+        model = app_cache.app_models[app_label].pop(model_name.lower())
     except KeyError:
         pass
+    else:
+        app_cache._get_models_cache.clear()
+        if hasattr(model, '_survey_id'):
+            registry.discard(model)
+
 
+def add_to_lru_cache(model):
+    """ Records a newly generated model (as its survey's current model),
+        evicting the least recently used
+        dynamic models if there are now too many.
+        Evicted models will be generated again when they are next needed.
+    """
+    from django.contrib import admin
+
+    registry.add(model)
+    app_label = model._meta.app_label
+    for evicted_app_label, evicted_name in lru.add(app_label, model._meta.object_name):
+        evicted_model = models.get_model(evicted_app_label, evicted_name)
+        remove_from_model_cache(evicted_app_label, evicted_name)
+        if evicted_model is not None and evicted_model in admin.site._registry:
+            unregister_from_admin(admin.site, evicted_model)
+        logger.debug("Evicted dynamic model %s.%s" % (evicted_app_label, evicted_name))
+
+@instrumentation.timed('schema.create_table', instrumentation.model_tags)
 def create_db_table(model_class):
     """ Takes a Django model class and create a database table, if necessary.
     """
@@ -148,16 +327,18 @@ def create_db_table(model_class):
     table_name = model_class._meta.db_table
 
     # Introspect the database to see if it doesn't already exist
-    if (connection.introspection.table_name_converter(table_name) 
-                        not in connection.introspection.table_names()):
+    # (unless the whole schema has already been read)
+    with schema.sync(table_name) as snapshot:
+        if not snapshot.has_table(table_name):
 
-        fields = _get_fields(model_class)
+            fields = _get_fields(model_class)
 
-        db.create_table(table_name, fields)
-        # Some fields are added differently, after table creation
-        # eg GeoDjango fields
-        db.execute_deferred_sql()
-        logger.debug("Created table '%s'" % table_name)
+            db.create_table(table_name, fields)
+            # Some fields are added differently, after table creation
+            # eg GeoDjango fields
+            db.execute_deferred_sql()
+            snapshot.add_table(table_name, [f.column for name, f in fields])
+            logger.debug("Created table '%s'" % table_name)
 
     db.commit_transaction()
 
@@ -166,6 +347,8 @@ def delete_db_table(model_class):
     table_name = model_class._meta.db_table
     db.start_transaction()
     db.delete_table(table_name)
+    if schema.get_current_snapshot() is not None:
+        schema.get_current_snapshot().remove_table(table_name)
     logger.debug("Deleted table '%s'" % table_name)
     db.commit_transaction()
 
@@ -175,26 +358,46 @@ def _get_fields(model_class):
     return [(f.name, f) for f in model_class._meta.local_fields]
 
 
+@instrumentation.timed('schema.add_columns', instrumentation.model_tags)
 def add_necessary_db_columns(model_class):
     """ Creates new table or relevant columns as necessary based on the model_class.
         No columns or data are renamed or removed.
         This is available in case a database exception occurs.
     """
     db.start_transaction()
+    table_name = model_class._meta.db_table
 
-    # Create table if missing
-    create_db_table(model_class)
+    # The table and its columns are read together, only once
+    with schema.sync(table_name) as snapshot:
 
-    # Add field columns if missing
-    table_name = model_class._meta.db_table
-    fields = _get_fields(model_class)
-    db_column_names = [row[0] for row in connection.introspection.get_table_description(connection.cursor(), table_name)]
+        # Create table if missing
+        create_db_table(model_class)
 
-    for field_name, field in fields:
-        if field.column not in db_column_names:
+        # Add field columns if missing
+        fields = _get_fields(model_class)
+        db_column_names = snapshot.get_columns(table_name)
+
+        missing = [(n, f) for n, f in fields if f.column not in db_column_names]
+
+        # Other backends can add several columns with one statement (and
+        # one pass over the table). South adds SQLite columns by remaking
+        # the table anyway.
+        if len(missing) > 1 and connection.vendor != 'sqlite':
+            db.execute('ALTER TABLE %s %s' % (db.quote_name(table_name), ', '.join(
+                'ADD COLUMN %s' % db.column_sql(table_name, n, f) for n, f in missing)))
+            logger.debug("Adding fields %s to table '%s'" % (', '.join(n for n, f in missing), table_name))
+            for field_name, field in missing:
+                snapshot.add_column(table_name, field.column)
+            missing = []
+
+        for field_name, field in missing:
             logger.debug("Adding field '%s' to table '%s'" % (field_name, table_name))
             db.add_column(table_name, field_name, field)
+            snapshot.add_column(table_name, field.column)
 
+        # The columns keep their database defaults (as add_column does with
+        # keep_default), so processes still using the previous model can
+        # go on inserting rows without them.
 
     # Some columns require deferred SQL to be run. This was collected 
     # when running db.add_column().
@@ -203,22 +406,65 @@ def add_necessary_db_columns(model_class):
     db.commit_transaction()
 
 
+@instrumentation.timed('schema.rename_column', instrumentation.model_tags)
 def rename_db_column(model_class, old_name, new_name):
     """ Rename a sensor's database column. """
     table_name = model_class._meta.db_table
     db.start_transaction()
     db.rename_column(table_name, old_name, new_name) 
+    if schema.get_current_snapshot() is not None:
+        schema.get_current_snapshot().rename_column(table_name, old_name, new_name)
     logger.debug("Renamed column '%s' to '%s' on %s" % (old_name, new_name, table_name))
     db.commit_transaction()
 
 
+@instrumentation.timed('model.notify', instrumentation.model_tags)
 def notify_model_change(model):
-    """ Notifies other processes that a dynamic model has changed. 
+    """ Notifies other processes that a dynamic model has changed, so they
+        can drop their outdated model straight away (they would otherwise
+        regenerate it when they next see the survey's new schema version).
         This should only ever be called after the required database changes have been made.
     """
-    CACHE_KEY = HASH_CACHE_TEMPLATE % (model._meta.app_label, model._meta.object_name) 
-    cache.set(CACHE_KEY, model._hash)
-    logger.debug("Setting \"%s\" hash to: %s" % (model._meta.verbose_name, model._hash))
+    transport = invalidation.get_transport()
+    if transport is None:
+        return
+    logger.debug("Announcing \"%s\" version %s" % (model._meta.verbose_name, model._schema_version))
+    try:
+        transport.publish({
+            'app_label': model._meta.app_label,
+            'model_name': model._meta.object_name,
+            'version': model._schema_version,
+            })
+    except Exception:
+        logger.exception("Could not publish change to \"%s\"" % model._meta.verbose_name)
+
+
+def start_invalidation_listener(sender=None, **kwargs):
+    """ Listens for model changes announced by other processes, if a
+        transport has been configured. This is connected to request_started
+        (see models.py), so that management commands don't listen, and
+        servers that fork their workers only listen in each worker.
+    """
+    request_started.disconnect(start_invalidation_listener)
+    invalidation.start_listening(handle_model_change)
+
+
+def handle_model_change(event):
+    """ Drops our model if another process has announced a newer version. """
+    app_label, model_name = event['app_label'], event['model_name']
+
+    # The model's lock is held, so that a model that a request has just
+    # generated for the new version isn't dropped
+    with get_model_lock(app_label, model_name):
+        model = models.get_model(app_label, model_name)
+        if model is None:
+            return
+
+        # Ignore late messages about older versions
+        if event['version'] > model._schema_version:
+            logger.debug("Dynamic model %s.%s was changed by another process" % (app_label, model_name))
+            remove_from_model_cache(app_label, model_name)
 
 
-HASH_CACHE_TEMPLATE = 'dynamic_model_hash_%s-%s'
+SCHEMA_LEASE_CACHE_TEMPLATE = 'dynamic_model_schema_lease_%s-%s'
+SCHEMA_CHECKED_CACHE_TEMPLATE = 'dynamic_model_schema_checked_%s-%s'
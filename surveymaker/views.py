@@ -1,24 +1,49 @@
 # -*- coding: UTF-8 -*-
 
 from .models import Survey
+from .dynamic_models import get_survey_response_models
+from . import app_settings
+from . import ingest
+from . import write_queue
+from .export import EXPORT_FORMATS
 
 from django import forms
+from django.core.paginator import Paginator, EmptyPage, PageNotAnInteger
+from django.http import HttpResponse, HttpResponseForbidden, Http404
 from django.shortcuts import render_to_response, get_object_or_404, redirect
 from django.template.context import RequestContext
+from django.utils import simplejson
+from django.views.decorators.csrf import csrf_exempt
+from django.views.decorators.http import require_POST
 
 def all_survey_responses(request):
     template_name = "surveymaker/all.html"
 
-    surveys = [(survey, survey.Response.objects.all()) 
-                                    for survey in Survey.objects.all()]
-    return render_to_response(template_name, {'surveys': surveys}, 
+    # Show a page of surveys, with only the latest responses to each
+    paginator = Paginator(Survey.objects.order_by('pk'), app_settings.INDEX_PAGE_SIZE)
+    try:
+        page = paginator.page(request.GET.get('page', 1))
+    except (EmptyPage, PageNotAnInteger):
+        raise Http404
+
+    surveys = page.object_list
+    latest = app_settings.INDEX_LATEST_RESPONSES
+    surveys = [(survey, list(Response.objects.order_by('-pk')[:latest].rows()))
+                for survey, Response in zip(surveys, get_survey_response_models(surveys))]
+    return render_to_response(template_name, {'surveys': surveys, 'page': page}, 
                                 context_instance=RequestContext(request))
 
 
 def get_response_form(response):
-    class FormMeta:
-        model = response
-    return type('ResponseForm', (forms.ModelForm,), {'Meta': FormMeta})
+    """ Returns a ModelForm class for the given response model. It is kept on
+        the model, so that it is built once per model version and replaced
+        along with the model.
+    """
+    if '_response_form' not in response.__dict__:
+        class FormMeta:
+            model = response
+        response._response_form = type('ResponseForm', (forms.ModelForm,), {'Meta': FormMeta})
+    return response._response_form
 
 
 def survey_form(request, survey_slug):
@@ -30,7 +55,8 @@ def survey_form(request, survey_slug):
     if request.method == "POST":
         form = ResponseForm(request.POST)
         if form.is_valid():
-            form.save()
+            if not write_queue.queue_response(Response, form.cleaned_data):
+                form.save()
             return redirect('surveymaker_index')
     else:
         form = ResponseForm()
@@ -38,3 +64,71 @@ def survey_form(request, survey_slug):
     return render_to_response(template_name, {'form': form, 'survey': survey}, 
                                 context_instance=RequestContext(request))
 
+
+
+# The content types bulk_upload accepts, and the reader of each
+BULK_UPLOAD_FORMATS = {
+    'text/csv': ingest.read_csv,
+    'application/json': ingest.read_jsonl,
+    'application/x-ndjson': ingest.read_jsonl,
+    }
+
+
+@csrf_exempt
+@require_POST
+def bulk_upload(request, survey_slug):
+    """ Saves many responses at once, eg. those collected offline.
+        The body is either CSV (with a header row of question slugs, when
+        the content type is text/csv) or one JSON object per line
+        (application/json or application/x-ndjson). It is read and saved a
+        chunk at a time.
+        Responds with the number of responses saved and the errors for each
+        row that was not.
+
+        The view is exempt from CSRF checks, as the CSRF middleware would
+        read the whole body to look for a token (and uploads aren't made
+        from forms). Forms on other sites can't send these content types,
+        so the staff check is enough.
+    """
+    if not request.user.is_staff:
+        return HttpResponseForbidden()
+    survey = get_object_or_404(Survey, slug=survey_slug)
+
+    content_type = request.META.get('CONTENT_TYPE', '').split(';')[0].strip()
+    if content_type not in BULK_UPLOAD_FORMATS:
+        return HttpResponse("Please send CSV (text/csv) or JSON lines (application/x-ndjson).",
+                            status=415, mimetype='text/plain')
+
+    lines = ingest.read_lines(request, int(request.META.get('CONTENT_LENGTH') or 0))
+    rows = BULK_UPLOAD_FORMATS[content_type](lines)
+    created, errors = ingest.bulk_create_responses(survey.Response, rows)
+
+    data = {'created': created, 'errors': [{'row': n, 'errors': e} for n, e in errors]}
+    return HttpResponse(simplejson.dumps(data), mimetype='application/json')
+
+
+def export_responses(request, survey_slug, format):
+    """ Streams all of a survey's responses as CSV or JSON lines. """
+    if not request.user.is_staff:
+        return HttpResponseForbidden()
+    survey = get_object_or_404(Survey, slug=survey_slug)
+    try:
+        export, mimetype = EXPORT_FORMATS[format]
+    except KeyError:
+        raise Http404
+
+    # The response content is generated as it is sent
+    response = HttpResponse(export(survey.Response), mimetype=mimetype)
+    response['Content-Disposition'] = 'attachment; filename=%s.%s' % (survey.slug, format)
+    return response
+
+
+def write_queue_stats(request):
+    """ Reports how many responses are waiting to be saved, and how long
+        saving the last batch took.
+    """
+    if not request.user.is_staff:
+        return HttpResponseForbidden()
+    queue = write_queue.get_queue()
+    stats = queue.get_stats() if queue is not None else {}
+    return HttpResponse(simplejson.dumps(stats), mimetype='application/json')
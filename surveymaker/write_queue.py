@@ -0,0 +1,217 @@
+# -*- coding: UTF-8 -*-
+""" A write-behind queue for survey responses (when SURVEYMAKER_WRITE_QUEUE_PATH
+    is set), so that submitting a response doesn't wait for the database.
+
+    Submitted answers are appended to a local SQLite spool file, and a
+    background thread inserts them a batch at a time with ingest's multi-row
+    inserts. Responses in the spool survive restarts, and are saved once any
+    process using the same spool starts again. Each response is removed from
+    the spool just before its insert is committed, so a flush that fails
+    partway leaves only unsaved responses to try again; a response could
+    only be lost if a process dies between the two.
+"""
+
+import logging
+import os
+import sqlite3
+import threading
+import time
+
+from django.core.serializers.json import DjangoJSONEncoder
+from django.db.models import get_model
+from django.utils import simplejson
+
+from . import app_settings
+from . import ingest
+
+logger = logging.getLogger('surveymaker')
+
+
+class QueueFull(Exception):
+    pass
+
+
+class WriteQueue(object):
+    """ Responses waiting to be saved, in a SQLite file at the given path.
+        Responses claimed by a process that hasn't flushed them within
+        claim_timeout seconds are flushed by another process.
+    """
+
+    def __init__(self, path, max_size=10000, batch_size=500, flush_interval=1.0, claim_timeout=300):
+        self.path = path
+        self.max_size = max_size
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.claim_timeout = claim_timeout
+        self.token = '%s-%s' % (os.getpid(), id(self))
+
+        self._lock = threading.Lock()
+        self._wake = threading.Event()
+        self._db = sqlite3.connect(path, timeout=30, check_same_thread=False,
+                                   isolation_level=None)
+        self._db.execute('PRAGMA journal_mode=WAL')
+        self._db.execute('CREATE TABLE IF NOT EXISTS spool (id INTEGER PRIMARY KEY, '
+                         'survey_id INTEGER, answers TEXT, claimed_by TEXT, claimed_at REAL)')
+
+        self.depth = self._count()
+        self.queued = 0
+        self.flushed = 0
+        self.rejected = 0
+        self.failed = 0
+        self.last_flush_size = 0
+        self.last_flush_time = None
+
+    def put(self, Response, answers):
+        """ Adds the answers (a dict of field name to value, eg. a response
+            form's cleaned_data) to the queue.
+            Raises QueueFull if there are already max_size responses waiting.
+        """
+        data = simplejson.dumps(answers, cls=DjangoJSONEncoder)
+        with self._lock:
+            # Other processes add to and flush the same spool
+            self.depth = self._count()
+            if self.depth >= self.max_size:
+                self.rejected += 1
+                raise QueueFull("%d responses are waiting to be saved." % self.depth)
+            self._db.execute('INSERT INTO spool (survey_id, answers) VALUES (?, ?)',
+                             (Response._survey_id, data))
+            self.depth += 1
+            self.queued += 1
+        if self.depth >= self.batch_size:
+            self._wake.set()
+
+    def flush(self):
+        """ Saves a batch of waiting responses. Returns the number of
+            responses taken from the queue, including any that couldn't be
+            saved (which are logged).
+        """
+        started = time.time()
+        rows = self._claim()
+        if not rows:
+            return 0
+
+        Survey = get_model('surveymaker', 'Survey')
+        spool_ids = {}
+        by_survey = {}
+        for spool_id, survey_id, data in rows:
+            spool_ids.setdefault(survey_id, []).append(spool_id)
+            by_survey.setdefault(survey_id, []).append(simplejson.loads(data))
+
+        created = 0
+        for survey in Survey.objects.filter(pk__in=by_survey.keys()):
+            ids = spool_ids.pop(survey.pk)
+            # Saved rows leave the spool as they are inserted, so that they
+            # aren't saved again if a later insert fails
+            on_insert = lambda row_numbers: self._remove([ids[n - 1] for n in row_numbers])
+            survey_created, errors = ingest.bulk_create_responses(
+                survey.Response, by_survey.pop(survey.pk), chunk_size=self.batch_size,
+                on_insert=on_insert)
+            created += survey_created
+            for row_number, row_errors in errors:
+                logger.error("Could not save queued response to %s: %s" % (survey, row_errors))
+            self.failed += len(errors)
+            self._remove([ids[row_number - 1] for row_number, row_errors in errors])
+
+        # Responses to surveys that have since been deleted
+        for survey_id, answers in by_survey.items():
+            logger.error("Could not save %d queued responses to deleted survey %s" % (len(answers), survey_id))
+            self.failed += len(answers)
+            self._remove(spool_ids[survey_id])
+
+        with self._lock:
+            self.depth = self._count()
+        self.flushed += created
+        self.last_flush_size = len(rows)
+        self.last_flush_time = time.time() - started
+        logger.debug("Flushed %d queued responses in %.3fs" % (len(rows), self.last_flush_time))
+        return len(rows)
+
+    def get_stats(self):
+        with self._lock:
+            self.depth = self._count()
+        return {'depth': self.depth, 'max_size': self.max_size, 'queued': self.queued,
+                'flushed': self.flushed, 'rejected': self.rejected, 'failed': self.failed,
+                'last_flush_size': self.last_flush_size, 'last_flush_time': self.last_flush_time}
+
+    def start(self):
+        """ Flushes the queue in a background thread, every flush_interval
+            seconds or as soon as a batch is waiting.
+        """
+        thread = threading.Thread(target=self._flush_forever, name='surveymaker-write-queue')
+        thread.daemon = True
+        thread.start()
+        return thread
+
+    def _flush_forever(self):
+        while True:
+            self._wake.wait(self.flush_interval)
+            self._wake.clear()
+            try:
+                # Keep going while there are full batches waiting
+                while self.flush() >= self.batch_size:
+                    pass
+            except Exception:
+                logger.exception("Could not flush the response write queue")
+
+    def _claim(self):
+        """ Marks a batch of unclaimed (or abandoned) responses as ours, and
+            returns them.
+        """
+        now = time.time()
+        with self._lock:
+            self._db.execute('BEGIN IMMEDIATE')
+            try:
+                self._db.execute('UPDATE spool SET claimed_by = ?, claimed_at = ? WHERE id IN '
+                                 '(SELECT id FROM spool WHERE claimed_by IS NULL OR claimed_at < ? '
+                                 'ORDER BY id LIMIT ?)',
+                                 (self.token, now, now - self.claim_timeout, self.batch_size))
+                self._db.execute('COMMIT')
+            except Exception:
+                self._db.execute('ROLLBACK')
+                raise
+            return self._db.execute('SELECT id, survey_id, answers FROM spool '
+                                    'WHERE claimed_by = ? ORDER BY id', (self.token,)).fetchall()
+
+    def _remove(self, spool_ids):
+        with self._lock:
+            self._db.executemany('DELETE FROM spool WHERE id = ?', [(i,) for i in spool_ids])
+
+    def _count(self):
+        return self._db.execute('SELECT COUNT(*) FROM spool').fetchone()[0]
+
+
+_queue = None
+_queue_lock = threading.Lock()
+
+
+def get_queue():
+    """ Returns the configured queue, with its flushing thread started, or
+        None if responses are saved directly.
+    """
+    global _queue
+    if _queue is None and app_settings.WRITE_QUEUE_PATH:
+        with _queue_lock:
+            if _queue is None:
+                queue = WriteQueue(app_settings.WRITE_QUEUE_PATH,
+                                   max_size=app_settings.WRITE_QUEUE_MAX_SIZE,
+                                   batch_size=app_settings.BULK_CHUNK_SIZE,
+                                   flush_interval=app_settings.WRITE_QUEUE_FLUSH_INTERVAL)
+                queue.start()
+                _queue = queue
+    return _queue
+
+
+def queue_response(Response, answers):
+    """ Queues a response to be saved in the background. Returns False if it
+        should be saved directly instead, as there is no queue or no room in
+        it (so submitters wait for the database, instead of the queue growing
+        without bound).
+    """
+    queue = get_queue()
+    if queue is None:
+        return False
+    try:
+        queue.put(Response, answers)
+    except QueueFull:
+        return False
+    return True
@@ -3,8 +3,19 @@ from django.conf.urls.defaults import patterns, include, url
 from django.contrib import admin
 admin.autodiscover()
 
+from surveymaker import app_settings
+
 urlpatterns = patterns('',
     url(r'^$', 'surveymaker.views.all_survey_responses', name='surveymaker_index'),
     url(r'^(?P<survey_slug>.*)/new/$', 'surveymaker.views.survey_form', name='surveymaker_form'),
+    url(r'^(?P<survey_slug>[^/]+)/upload/$', 'surveymaker.views.bulk_upload', name='surveymaker_upload'),
+    url(r'^queue/$', 'surveymaker.views.write_queue_stats', name='surveymaker_write_queue'),
+    url(r'^(?P<survey_slug>[^/]+)/export\.(?P<format>\w+)$', 'surveymaker.views.export_responses', name='surveymaker_export'),
     url(r'^admin/', include(admin.site.urls)),
 )
+
+# Response models are looked up for each request, rather than registered
+if app_settings.DYNAMIC_ADMIN:
+    urlpatterns = patterns('',
+        url(r'^admin/responses/(?P<survey_slug>[^/]+)/(?P<url>.*)$', 'surveymaker.admin.response_admin_view', name='surveymaker_response_admin'),
+    ) + urlpatterns